@@ -1,5 +1,6 @@
 import os
 import asyncio
+import functools
 import time
 import shutil
 from datetime import datetime
@@ -7,6 +8,19 @@ from telethon import TelegramClient, events
 import logging
 
 import tgutils
+import logutils
+from outbox import Outbox
+from downloads import (
+    DownloadScheduler,
+    PrioritySlots,
+    RateLimiter,
+    SingleFlight,
+    choose_server_size,
+    priority_value,
+)
+from renditions import RenditionCache
+from transcoder import TranscoderClient
+from retention import MediaRetention
 
 logger = logging.getLogger(__name__)
 
@@ -20,9 +34,18 @@ class InternalMessageStatus:
         return [0, "CREATED", "DOWNLOADING", "READY"][status]
 
 
+class JobPriority:
+    # Lower values are served first by the download, render and publish queues
+    LIVE = 0
+    BACKFILL = 1
+
+    def stringify(priority):
+        return ["live", "backfill"][priority]
+
+
 class InternalMessage:
     required_fields = ["id", "date"]
-    optional_fields = ["group_id", "text", "media"]
+    optional_fields = ["group_id", "text", "media", "priority"]
 
     def __init__(self, **kwargs):
         for field in InternalMessage.required_fields:
@@ -66,6 +89,30 @@ class MessageDownloader:
         self.__set_default_values()
         self._set_fields(**kwargs)
         self.fetching_done = asyncio.Event()
+        # Set when a live post may have become ready, checked before every backfill send
+        self.live_ready = asyncio.Event()
+        self._log_event = logutils.EventLogSampler(
+            logger, self.event_log_sample_rate, self.event_log_max_length
+        )
+        self.downloads = DownloadScheduler(
+            concurrency=self.download_concurrency,
+            parallel_threshold=self.download_parallel_threshold,
+            connections=self.download_connections,
+            bytes_per_second=self.download_bytes_per_second,
+            resumable_threshold=self.download_resumable_threshold,
+        )
+        self.render_slots = PrioritySlots(int(self.render_concurrency))
+        self.media_flights = SingleFlight()
+        self.retention = MediaRetention(
+            self.image_path,
+            self.video_path,
+            self.fastimage_path,
+            self.thumbnail_path,
+            max_age_days=self.retention_max_age_days,
+            max_bytes=self.retention_max_bytes,
+            # Resumable downloads are written to the working directory
+            partial_path=os.curdir,
+        )
 
     async def __aenter__(self):
         # Set up resources, e.g., open a connection
@@ -89,6 +136,37 @@ class MessageDownloader:
         "hashtags",
         "start_date",
         "dry",
+        "event_log_sample_rate",
+        "event_log_max_length",
+        "outbox_path",
+        "outbox_max_entries",
+        "outbox_retry_interval",
+        "outbox_max_attempts",
+        "outbox_replay_batch",
+        "outbox_max_dead_entries",
+        "outbox_dead_max_age_days",
+        "download_concurrency",
+        "download_parallel_threshold",
+        "download_connections",
+        "download_bytes_per_second",
+        "download_resumable_threshold",
+        "history_shards",
+        "history_requests_per_second",
+        "rendition_cache_path",
+        "fastimage_ratio",
+        "fastimage_quality",
+        "thumbnail_width",
+        "thumbnail_quality",
+        "webp_time_budget",
+        "render_concurrency",
+        "rendition_source",
+        "transcoder_socket",
+        "transcoder_city",
+        "transcoder_timeout",
+        "retention_max_age_days",
+        "retention_max_bytes",
+        "retention_interval",
+        "media_layout",
     ]
 
     def __set_required_fields(self, **kwargs):
@@ -118,6 +196,12 @@ class MessageDownloader:
         self.ignored_group_ids = []
 
         self.latest_group_id = None
+        self.client = None
+        self.sender_task = None
+        self.retention_task = None
+        self.outbox = None
+        self.rendition_cache = None
+        self.transcoder = None
 
         self.create_url = "example.com/api/create"
         self.delete_url = "example.com/api/delete"
@@ -135,6 +219,37 @@ class MessageDownloader:
             "#18+",
             "#топновости",
         ]
+        self.event_log_sample_rate = 1
+        self.event_log_max_length = 2000
+        self.outbox_max_entries = 10000
+        self.outbox_retry_interval = 30
+        self.outbox_max_attempts = 10
+        self.outbox_replay_batch = 20
+        self.outbox_max_dead_entries = 10000
+        self.outbox_dead_max_age_days = 30
+        self.download_concurrency = 3
+        self.download_parallel_threshold = 20 * 1024 * 1024
+        self.download_connections = 4
+        self.download_bytes_per_second = 0
+        self.download_resumable_threshold = 5 * 1024 * 1024
+        self.history_shards = 4
+        self.history_requests_per_second = 2
+        self.fastimage_ratio = 0.5
+        self.fastimage_quality = 50
+        self.thumbnail_width = 300
+        self.thumbnail_quality = 50
+        self.webp_time_budget = tgutils.WEBP_TIME_BUDGET
+        self.render_concurrency = os.cpu_count() or 1
+        # "local" renders everything from the downloaded original, "server"
+        # starts video previews from a thumb Telegram already provides
+        self.rendition_source = "local"
+        self.transcoder_city = os.path.split(os.getcwd())[1]
+        # Seconds a started transcoder job may run before rendering in-process, 0 = forever
+        self.transcoder_timeout = 300
+        self.retention_interval = 3600
+        # "flat" ({dir}/{id}.ext) or "sharded" ({dir}/{id[-2:]}/{id[-4:-2]}/{id}.ext).
+        # Filenames sent to the API are bare names in both layouts.
+        self.media_layout = "flat"
 
     # Проверка типа медиа (изображение или видео)
     def get_media_type(self, message):
@@ -153,39 +268,184 @@ class MessageDownloader:
             return self.video_path
         return None
     
-    def __generate_compressed_images(self, filename):
-        image_path = os.path.join(self.image_path, filename)
-        tgutils.compress_image(
+    def _get_rendition_cache(self):
+        if self.rendition_cache is None:
+            cache_path = self.rendition_cache_path or os.path.join(
+                os.path.dirname(os.path.abspath(self.image_path)), "renditions.sqlite"
+            )
+            self.rendition_cache = RenditionCache(cache_path)
+        return self.rendition_cache
+
+    async def _run_render(self, render_func, *args, priority=JobPriority.LIVE, **kwargs):
+        """Runs a tgutils rendition function on the shared transcoder if configured, else in a thread"""
+        if self.transcoder_socket:
+            if self.transcoder is None:
+                self.transcoder = TranscoderClient(
+                    self.transcoder_socket, self.transcoder_city, self.transcoder_timeout
+                )
+            try:
+                # The service runs in its own working directory
+                return await self.transcoder.run(
+                    render_func.__name__,
+                    *(os.path.abspath(path) for path in args),
+                    priority=JobPriority.stringify(priority_value(priority)),
+                    **kwargs,
+                )
+            except OSError as e:
+                logger.warning(f"Transcoder unavailable ({e}), rendering in-process")
+        await self.render_slots.acquire(priority)
+        try:
+            return await asyncio.to_thread(render_func, *args, **kwargs)
+        finally:
+            self.render_slots.release()
+
+    def _media_file(self, directory, filename):
+        """Where `filename` is written in `directory` for the configured `media_layout`"""
+        return tgutils.media_file_path(directory, filename, self.media_layout == "sharded")
+
+    def _existing_media_file(self, directory, filename):
+        """Existing file in either layout, else where it would be written"""
+        return tgutils.find_media_file(directory, filename) or self._media_file(directory, filename)
+
+    def _rendition_file(self, directory, filename):
+        return self._media_file(directory, tgutils.generate_new_file_path("", filename))
+
+    def _server_size(self, sizes, min_width, max_width=None):
+        if self.rendition_source != "server":
+            return None
+        return choose_server_size(sizes, min_width, max_width)
+
+    async def __download_server_size(self, message, size, priority):
+        path = await self.downloads.download(
+            message, file=f"{message.id}_{size.type}.jpg", priority=priority, thumb=size
+        )
+        if not path:
+            raise OSError(f"Failed to download size '{size.type}' of message {message.id}")
+        return path
+
+    async def __render_from_server_size(
+        self, message, size, render_func, source_path, output_path, priority, **params
+    ):
+        """
+        Renders `output_path` from the Telegram-provided `size` of the
+        message's media instead of `source_path`. Returns None on failure.
+        """
+        try:
+            return await self._get_rendition_cache().render(
+                render_func,
+                source_path,
+                output_path,
+                run=functools.partial(self._run_render, priority=priority),
+                variant=f"server:{size.type}",
+                fetch_source=functools.partial(
+                    self.__download_server_size, message, size, priority
+                ),
+                **params,
+            )
+        except Exception as e:
+            logger.warning(
+                f"Rendering {output_path} from server size '{size.type}' failed ({e}), "
+                "rendering locally"
+            )
+            return None
+
+    async def __render_rendition(
+        self, message, size, source_path, output_path, priority, server_render, local_render
+    ):
+        """
+        Renders `output_path` with `server_render` = (render_func, params) from
+        the Telegram-provided `size` if there is one, else or when that fails
+        with `local_render` from `source_path`. A local fallback is cached under
+        `size`, so the server size isn't fetched again while the source is unchanged.
+        """
+        renditions = self._get_rendition_cache()
+        local_func, local_params = local_render
+        variant = None
+        if size:
+            variant = f"fallback:server:{size.type}"
+            if renditions.is_rendered(
+                local_func, source_path, output_path, variant=variant, **local_params
+            ):
+                logger.debug(f"Rendition {output_path} is up to date")
+                return output_path
+            server_func, server_params = server_render
+            if await self.__render_from_server_size(
+                message, size, server_func, source_path, output_path, priority, **server_params
+            ):
+                return output_path
+        return await renditions.render(
+            local_func,
+            source_path,
+            output_path,
+            run=functools.partial(self._run_render, priority=priority),
+            variant=variant,
+            **local_params,
+        )
+
+    async def __generate_compressed_images(self, filename, priority):
+        # Always from the original: a photo's original is downloaded anyway, so
+        # fetching a server size as well would cost more than the decoding it saves
+        image_path = self._existing_media_file(self.image_path, filename)
+        renditions = self._get_rendition_cache()
+        run = functools.partial(self._run_render, priority=priority)
+        await renditions.render(
+            tgutils.compress_image,
             image_path, 
-            tgutils.generate_new_file_path(self.fastimage_path, filename)
+            self._rendition_file(self.fastimage_path, filename),
+            run=run,
+            ratio=float(self.fastimage_ratio),
+            quality=int(self.fastimage_quality),
+            time_budget=float(self.webp_time_budget),
         )
-        tgutils.compress_thumbnail(
+        await renditions.render(
+            tgutils.compress_thumbnail,
             image_path, 
-            tgutils.generate_new_file_path(self.thumbnail_path, filename)
+            self._rendition_file(self.thumbnail_path, filename),
+            run=run,
+            quality=int(self.thumbnail_quality),
+            width=int(self.thumbnail_width),
+            time_budget=float(self.webp_time_budget),
         )
 
 
-    def __convert_image_to_webp(self, image_path, message_id):
-        return tgutils.compress_image(
+    async def __convert_image_to_webp(self, image_path, message_id, priority):
+        return await self._run_render(
+            tgutils.compress_image,
             image_path, 
-            tgutils.generate_new_file_path(self.image_path, str(message_id)), 
+            self._rendition_file(self.image_path, str(message_id)), 
             ratio=1,
-            quality=80
+            quality=80,
+            time_budget=float(self.webp_time_budget),
+            priority=priority,
         )
 
 
-    def __generate_preview_from_video(self, filename):
+    async def __generate_preview_from_video(self, filename, priority, message=None):
         name, ext = os.path.splitext(filename)
         preview_filename = f"{name}.webp"
-        tgutils.extract_frame(
-            os.path.join(self.video_path, filename),
-            os.path.join(self.image_path, preview_filename)
+        video_path = self._existing_media_file(self.video_path, filename)
+        preview_path = self._existing_media_file(self.image_path, preview_filename)
+
+        # The video's own thumb saves decoding a frame. The preview is the source
+        # of the video's fastimage and thumbnail, so it has to be wide enough
+        # for the fastimage to stay at least as wide as the thumbnail.
+        thumbs = message.document.thumbs if message and message.document else []
+        preview_width = int(self.thumbnail_width) / min(float(self.fastimage_ratio), 1)
+        size = self._server_size(thumbs, preview_width)
+        await self.__render_rendition(
+            message, size, video_path, preview_path, priority,
+            server_render=(tgutils.compress_image, {
+                "ratio": 1,
+                "quality": 80,
+                "time_budget": float(self.webp_time_budget),
+            }),
+            local_render=(tgutils.extract_frame, {"frame_number": 0}),
         )
-        self.__generate_compressed_images(preview_filename)
+        await self.__generate_compressed_images(preview_filename, priority)
         return preview_filename
 
-    async def __process_media_to_download(self, message):
-        media_temp_path = await message.download_media()
+    async def __process_media_to_download(self, message, priority):
+        media_temp_path = await self.downloads.download(message, priority=priority)
         if not media_temp_path:
             logger.warning(f"Failed to download media for message {message.id}")
             return ""
@@ -200,7 +460,7 @@ class MessageDownloader:
             # Process image differently
             try:
                 # Convert image to webp
-                webp_path = self.__convert_image_to_webp(media_temp_path, message.id)
+                webp_path = await self.__convert_image_to_webp(media_temp_path, message.id, priority)
                 media_filename = os.path.basename(webp_path)
                 logger.info(f"Converted and moved image to {webp_path}")
             except Exception as e:
@@ -210,10 +470,11 @@ class MessageDownloader:
                     os.remove(media_temp_path)
         elif media_type:
             # Handle other media types
-            media_destination = os.path.join(
+            media_destination = self._media_file(
                 self.get_media_path_from_type(media_type), media_filename
             )
             try:
+                tgutils.create_output_directories(os.path.dirname(media_destination))
                 await asyncio.to_thread(shutil.move, media_temp_path, media_destination)
                 logger.info(f"Downloaded media to {media_destination}")
             except Exception as e:
@@ -224,7 +485,18 @@ class MessageDownloader:
 
         return media_filename   
 
-    async def _process_media(self, message):
+    async def _process_media(self, message, priority=JobPriority.LIVE):
+        """
+        Single-flight per message and media id: a NewMessage and a
+        MessageEdited arriving together share one download and transcode.
+        A live caller joining backfill work raises its priority.
+        """
+        media_id = getattr(message.photo or message.document, "id", None)
+        return await self.media_flights.run(
+            (message.id, media_id), self.__process_media, message, priority=priority
+        )
+
+    async def __process_media(self, message, priority):
         downloaded_media = tgutils.is_media_downloaded(
             message.id, self.video_path, self.image_path
         )
@@ -233,7 +505,7 @@ class MessageDownloader:
             filename = downloaded_media[0].name
             logger.info(f"Skipped downloading {filename}")
         else:
-            filename = await self.__process_media_to_download(message)
+            filename = await self.__process_media_to_download(message, priority)
             if not filename:
                 return None
 
@@ -242,14 +514,15 @@ class MessageDownloader:
             "spoiler": getattr(message.media, 'spoiler', False),
         }
         if self.get_media_type(message) == "video":
-            media["preview"] = self.__generate_preview_from_video(filename)
-            self.__generate_compressed_images(media["preview"])
+            media["preview"] = await self.__generate_preview_from_video(
+                filename, priority, message
+            )
         else:
-            self.__generate_compressed_images(media["filename"])
+            await self.__generate_compressed_images(media["filename"], priority)
 
         return media
 
-    async def _process_message(self, message):
+    async def _process_message(self, message, priority=JobPriority.LIVE):
         group_id = message.grouped_id
 
         # If message doesn't have text and not in a group
@@ -279,44 +552,103 @@ class MessageDownloader:
             group_id=group_id,
             date=iso_date,
             text=message.text,
+            priority=priority,
         )
 
         if internal_message.group_id:
-            if internal_message.group_id in self.group_messages.keys():
-                self.group_messages[internal_message.group_id].append(internal_message)
-            else:
-                self.group_messages[internal_message.group_id] = [internal_message]
+            group = self.group_messages.setdefault(internal_message.group_id, [])
+            # A later update of the same message replaces its earlier entry
+            group[:] = [entry for entry in group if entry.id != internal_message.id]
+            group.append(internal_message)
         else:
             self.single_messages[internal_message.id] = internal_message
 
         if message.media:
             internal_message.update_status(InternalMessageStatus.DOWNLOADING_MEDIA)
-            internal_message.media = await self._process_media(message)
+            internal_message.media = await self._process_media(message, priority)
         internal_message.update_status(InternalMessageStatus.READY)
+        self._notify_ready(internal_message)
 
 
-    async def _get_messages(self, client, channel):
+    # History is fetched in requests of this many messages (Telegram's maximum)
+    HISTORY_BATCH_SIZE = 100
+
+    async def _get_messages_shard(self, client, channel, start_date, end_date, limiter):
         """
-        Returns an Iterable with messages ordered from oldest to newest
+        Messages with `start_date <= date < end_date`, newest first. Pages
+        explicitly, one `limiter` token per request.
         """
         messages = []
+        offset = {"offset_date": end_date}
+        while True:
+            await limiter.consume(1)
+            batch = await client.get_messages(
+                channel, limit=self.HISTORY_BATCH_SIZE, min_id=1, **offset
+            )
+            in_range = [
+                message for message in batch
+                if message.date.replace(tzinfo=None) >= start_date
+            ]
+            messages.extend(in_range)
+            # A short page is either the end of the history or of the range
+            if len(in_range) < self.HISTORY_BATCH_SIZE:
+                break
+            offset = {"offset_id": batch[-1].id}
+        logger.info(f"Fetched {len(messages)} messages from {start_date} to {end_date}")
+        return messages
+
+    async def _complete_first_album(self, client, channel, messages, max_amp=10):
+        """
+        Adds the earlier part of an album that started right before `start_date`
+        """
+        first = messages[0]
+        if first.grouped_id is None:
+            return messages
+        earlier = await client.get_messages(
+            channel, ids=list(range(max(first.id - max_amp, 1), first.id))
+        )
+        album_start = [
+            message for message in earlier
+            if message is not None and message.grouped_id == first.grouped_id
+        ]
+        return album_start + messages
 
+    async def _get_messages(self, client, channel):
+        """
+        Returns an Iterable with messages ordered from oldest to newest.
+        The date window is split into `history_shards` ranges that are
+        fetched concurrently under a shared request rate limit.
+        """
         start_date = datetime.fromisoformat(self.start_date)
         end_date = datetime.now()
 
-        async for message in client.iter_messages(
-            channel,
-            offset_date=end_date,
-            min_id=1,
-            limit=None,
-        ):
-            if message.date.replace(tzinfo=None) < start_date:
-                break
-            messages.append(message)
+        shards = max(int(self.history_shards), 1)
+        step = (end_date - start_date) / shards
+        bounds = [start_date + step * i for i in range(shards)] + [end_date]
+        limiter = RateLimiter(float(self.history_requests_per_second))
 
-        return reversed(messages)
+        shard_messages = await asyncio.gather(
+            *(
+                self._get_messages_shard(client, channel, bounds[i], bounds[i + 1], limiter)
+                for i in range(shards)
+            )
+        )
+
+        # Message ids grow with time in a channel, so sorting by id restores
+        # the order and keeps albums split between shards contiguous
+        messages = {
+            message.id: message for shard in shard_messages for message in shard
+        }
+        messages = [messages[message_id] for message_id in sorted(messages)]
+        if messages:
+            messages = await self._complete_first_album(client, channel, messages)
+        return messages
 
-    async def fetch_messages(self, client, channel):
+    async def fetch_messages(self, client, channel, mark_done=True):
+        """
+        Processes the history as backfill. `mark_done=False` keeps
+        `send_messages` running afterwards, for the combined live mode.
+        """
         try:
             messages = await self._get_messages(client, channel)
             logger.info(
@@ -325,7 +657,9 @@ class MessageDownloader:
 
             tasks = []
             for message in messages:
-                task = asyncio.create_task(self._process_message(message))
+                task = asyncio.create_task(
+                    self._process_message(message, JobPriority.BACKFILL)
+                )
                 tasks.append(task)
                 # # HACK: создание небольшой задержки для обработки сообщений по порядку
                 await asyncio.sleep(0.1)
@@ -337,7 +671,8 @@ class MessageDownloader:
             logger.error(f"Error fetching messages: {e}")
 
         finally:
-            self.fetching_done.set()
+            if mark_done:
+                self.fetching_done.set()
 
 
     async def _process_media_messages_in_group(self, client, original_message, max_amp=10):
@@ -368,28 +703,71 @@ class MessageDownloader:
         return tasks
 
     async def blm_new_message_handler(self, event):
-        logger.info(event)
+        self._log_event(event)
         if event.message:
             await self._process_message(event.message)
 
     async def blm_message_deleted_handler(self, event):
-        logger.info(event)
+        self._log_event(event)
         # add check for correct channel
         for deleted_id in event.deleted_ids:
-            await tgutils.delete_news(self.delete_url, deleted_id)
+            # Removing media of a post the API still shows would break it
+            if await self._unpublish(deleted_id):
+                self.retention.remove_message_media_in_background(deleted_id)
+            else:
+                logger.warning(f"Keeping media of message {deleted_id}, its deletion failed")
+
+    async def _unpublish(self, message_id):
+        """Deletes the message's post from the API, True once it is gone"""
+        result = await tgutils.delete_news(self.delete_url, message_id)
+        # 404: the post is already gone
+        return bool(result) or result.status == 404
 
     async def blm_message_edited_handler(self, event):
-        logger.info(event)
+        self._log_event(event)
         await self._process_media_messages_in_group(
             self.client, 
             event.message
         )
 
+    def _open_outbox(self, default_path):
+        if self.dry or self.outbox is not None:
+            return
+        self.outbox = Outbox(
+            self.outbox_path or default_path,
+            max_entries=self.outbox_max_entries,
+            max_attempts=self.outbox_max_attempts,
+            max_dead_entries=self.outbox_max_dead_entries,
+            dead_max_age_days=self.outbox_dead_max_age_days,
+        )
+        logger.info(f"Opened outbox {self.outbox.path} with {len(self.outbox)} pending entries")
+
+    async def __publish(self, key, converted_message: dict):
+        attempts = self.outbox.mark_attempt(key)
+        result = await tgutils.send_to_api(self.create_url, converted_message)
+        if result:
+            self.outbox.ack(key)
+        elif not result.retryable:
+            self.outbox.dead_letter(key, f"rejected with status {result.status}")
+        elif attempts >= self.outbox.max_attempts:
+            self.outbox.dead_letter(key, f"failed {attempts} attempts, last status {result.status}")
+
     async def __send_one_message(self, converted_message: dict):
         self.parsed_messages.append(converted_message)
-        if not self.dry:
+        if self.dry:
+            return
+        if self.outbox is None:
             await tgutils.send_to_api(self.create_url, converted_message)
-        
+            return
+        key = self.outbox.put(converted_message)
+        await self.__publish(key, converted_message)
+
+    async def __replay_outbox(self, retry_after=0, limit=None):
+        """Resends payloads the API hasn't acknowledged yet (at-least-once)"""
+        if self.outbox is None:
+            return
+        for key, converted_message in self.outbox.pending(retry_after, limit):
+            await self.__publish(key, converted_message)
 
     def convert_message_to_json_generator(self, transform: callable):
         return lambda message: tgutils.cleanup_text_in_json(
@@ -397,34 +775,79 @@ class MessageDownloader:
         )
 
     async def __send_prepared_messages(
-        self, messages: dict, condition: callable, transform: callable
+        self, messages: dict, condition: callable, transform: callable, preempt=None
     ):
         keys_to_remove = [key for key in messages if condition(messages[key])]
 
         for key in keys_to_remove:
+            if preempt and preempt():
+                return False
             message = messages[key]
             transformed_message = transform(message)
             await self.__send_one_message(transformed_message)
             logger.debug(f"Removing message {key}")
             del messages[key]
+        return True
 
-    async def __send_messages_cycle(self):
-        DELAY_IN_SECONDS = 3
+    # Album parts keep arriving for a while after the first one is ready
+    GROUP_DELAY_IN_SECONDS = 3
 
-        await self.__send_prepared_messages(
-            self.single_messages,
-            lambda message: message.status == InternalMessageStatus.READY,
-            self.convert_message_to_json_generator(tgutils.convert_message_to_data),
+    def _is_single_ready(self, message):
+        return message.status == InternalMessageStatus.READY
+
+    def _is_group_ready(self, group):
+        return all(
+            message.status == InternalMessageStatus.READY
+            and message.last_update < time.time() - self.GROUP_DELAY_IN_SECONDS
+            for message in group
         )
 
-        await self.__send_prepared_messages(
+    @staticmethod
+    def _group_priority(group):
+        # An album touched by a live update is live
+        return min(message.priority for message in group)
+
+    def _notify_ready(self, message):
+        """Sets `live_ready` when `message` turning READY may make a live post sendable"""
+        if message.group_id:
+            group = self.group_messages.get(message.group_id)
+            if group and self._group_priority(group) == JobPriority.LIVE:
+                # An album is sendable once it stayed unchanged for GROUP_DELAY_IN_SECONDS
+                asyncio.get_running_loop().call_later(
+                    self.GROUP_DELAY_IN_SECONDS + 0.1, self.live_ready.set
+                )
+        elif message.priority == JobPriority.LIVE:
+            self.live_ready.set()
+
+    async def __send_ready_messages(self, priority, preempt=None):
+        """Sends ready messages of `priority`, returns False if `preempt` stopped it"""
+        if priority == JobPriority.LIVE:
+            self.live_ready.clear()
+        return await self.__send_prepared_messages(
+            self.single_messages,
+            lambda message: message.priority == priority and self._is_single_ready(message),
+            self.convert_message_to_json_generator(tgutils.convert_message_to_data),
+            preempt,
+        ) and await self.__send_prepared_messages(
             self.group_messages,
-            lambda group: all(
-                message.status == InternalMessageStatus.READY
-                and message.last_update < time.time() - DELAY_IN_SECONDS
-                for message in group
-            ),
+            lambda group: self._group_priority(group) == priority and self._is_group_ready(group),
             self.convert_message_to_json_generator(tgutils.convert_group_to_data),
+            preempt,
+        )
+
+    async def __send_messages_cycle(self):
+        # Live posts go out first. Backfill yields as soon as a live post is
+        # ready, so a long history never holds back breaking news.
+        await self.__send_ready_messages(JobPriority.LIVE)
+        while not await self.__send_ready_messages(
+            JobPriority.BACKFILL, preempt=self.live_ready.is_set
+        ):
+            await self.__send_ready_messages(JobPriority.LIVE)
+
+        # Retries come last and a few per cycle, so a backlog of failing
+        # entries doesn't delay new posts
+        await self.__replay_outbox(
+            float(self.outbox_retry_interval), int(self.outbox_replay_batch)
         )
 
     async def send_messages(self):
@@ -456,13 +879,10 @@ class MessageDownloader:
         tgutils.create_output_directories(
             self.image_path, self.video_path, self.fastimage_path, self.thumbnail_path
         )
+        self._open_outbox(f"load_outbox_{self.api_id}.sqlite")
+        await asyncio.to_thread(self.retention.remove_stale_partials)
 
-        client = await TelegramClient(
-            f"load_session_{self.api_id}", # can't be arsed to fix that
-            # f"/var/www/TGMessageDownloader/load_session_{self.api_id}", # can't be arsed to fix that
-            self.api_id,
-            self.api_hash,
-        ).start(self.phone)
+        client = await self._connect_user_client()
 
         logger.info("`get_history()` session started and user authorized.")
         tasks = [
@@ -471,28 +891,121 @@ class MessageDownloader:
         ]
         await asyncio.gather(*tasks)
         await client.disconnect()
+        if self.outbox is not None:
+            self.outbox.close()
+            self.outbox = None
+        if self.rendition_cache is not None:
+            self.rendition_cache.close()
+            self.rendition_cache = None
         tgutils.write_messages_to_file(self.parsed_messages, f"{channel}.json")
 
-    async def get_new_messages(self, channel):
-        tgutils.create_output_directories(self.image_path, self.video_path)
-
-        client = await TelegramClient(
-            f"blm_session_{self.api_id}",
+    async def _connect_user_client(self):
+        return await TelegramClient(
+            f"load_session_{self.api_id}", # can't be arsed to fix that
+            # f"/var/www/TGMessageDownloader/load_session_{self.api_id}", # can't be arsed to fix that
             self.api_id,
             self.api_hash,
-        ).start(bot_token=self.bot_token)
+        ).start(self.phone)
 
-        self.client = client
+    # Errors that mean the connection itself is gone and the client
+    # has to reconnect. Anything else is logged and the loop keeps running.
+    TRANSPORT_ERRORS = (ConnectionError, OSError, asyncio.TimeoutError)
 
-        client.add_event_handler(
-            self.blm_new_message_handler, events.NewMessage(chats=channel)
-        )
-        client.add_event_handler(
-            self.blm_message_deleted_handler, events.MessageDeleted(chats=channel)
-        )
-        client.add_event_handler(
-            self.blm_message_edited_handler, events.MessageEdited(chats=channel)
+    async def _connect_bot_client(self, channel):
+        if self.client is None:
+            self.client = await TelegramClient(
+                f"blm_session_{self.api_id}",
+                self.api_id,
+                self.api_hash,
+            ).start(bot_token=self.bot_token)
+
+            self.client.add_event_handler(
+                self.blm_new_message_handler, events.NewMessage(chats=channel)
+            )
+            self.client.add_event_handler(
+                self.blm_message_deleted_handler, events.MessageDeleted(chats=channel)
+            )
+            self.client.add_event_handler(
+                self.blm_message_edited_handler, events.MessageEdited(chats=channel)
+            )
+            logger.info("`get_new_messages()` session started and user authorized.")
+        elif not self.client.is_connected():
+            # Session file keeps the authorization, no need to log in again
+            await self.client.connect()
+            logger.info("`get_new_messages()` reconnected.")
+        return self.client
+
+    def _ensure_sender_task(self):
+        if self.sender_task is None or self.sender_task.done():
+            self.sender_task = asyncio.create_task(self.send_messages())
+            self.sender_task.add_done_callback(self._on_sender_done)
+
+    def _on_sender_done(self, task):
+        """Restarts `send_messages()` right away if it died, even while the client stays connected"""
+        if task is not self.sender_task or task.cancelled():
+            return
+        exc = task.exception()
+        if exc:
+            logger.error("`send_messages()` stopped, restarting", exc_info=exc)
+            self._ensure_sender_task()
+
+    def _ensure_retention_task(self):
+        # Runs without quotas too, abandoned partial downloads are always removed
+        if self.retention_task is None or self.retention_task.done():
+            self.retention_task = asyncio.create_task(
+                self.retention.run(float(self.retention_interval), unpublish=self._unpublish)
+            )
+
+    async def get_new_messages(self, channel):
+        """
+        Runs the bot session until cancelled. The client, its handlers,
+        the `send_messages` task and all pending messages are kept across
+        failures; only transport errors trigger a reconnect.
+        """
+        tgutils.create_output_directories(self.image_path, self.video_path)
+        self._open_outbox(f"blm_outbox_{self.api_id}.sqlite")
+        backoff = 1
+
+        while True:
+            try:
+                client = await self._connect_bot_client(channel)
+                self._ensure_sender_task()
+                self._ensure_retention_task()
+                backoff = 1
+                await client.run_until_disconnected()
+                logger.warning("`get_new_messages()` disconnected, reconnecting")
+            except self.TRANSPORT_ERRORS as e:
+                logger.warning(f"Transport error: {e}. Reconnecting in {backoff}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+            except Exception:
+                logger.exception("Error in `get_new_messages()`, keeping session")
+                await asyncio.sleep(1)
+
+    async def get_new_messages_with_history(self, channel):
+        """
+        `get_new_messages` and `get_history` in one pipeline: the bot session
+        handles live updates while the user session backfills history from
+        `start_date`. Both share the download, render and publish queues, in
+        which live work always goes first. Runs until cancelled.
+        """
+        tgutils.create_output_directories(
+            self.image_path, self.video_path, self.fastimage_path, self.thumbnail_path
         )
-        logger.info("`get_new_messages()` session started and user authorized.")
-        task = asyncio.create_task(self.send_messages())
-        await client.run_until_disconnected()
+        # One outbox for both, so replays don't depend on which part published
+        self._open_outbox(f"blm_outbox_{self.api_id}.sqlite")
+        live = asyncio.create_task(self.get_new_messages(channel))
+        try:
+            try:
+                client = await self._connect_user_client()
+                logger.info("Backfill session started and user authorized.")
+                try:
+                    await self.fetch_messages(client, channel, mark_done=False)
+                finally:
+                    await client.disconnect()
+                logger.info("Backfill finished, continuing with live updates only")
+            except Exception:
+                logger.exception("Backfill failed, continuing with live updates only")
+            await live
+        finally:
+            live.cancel()
@@ -0,0 +1,292 @@
+"""
+Microbenchmarks for the hot helpers in tgutils, on synthetic fixtures
+generated locally (no network, no Telegram).
+
+    python benchmarks/tgutils_bench.py --save-baseline   # record on this host
+    python benchmarks/tgutils_bench.py                   # compare, exit 1 on regression
+
+A benchmark regresses when its ops/sec drops by more than --tolerance or
+its peak memory grows by more than --memory-tolerance relative to the
+baseline. Peak memory is how far a forked child running only that
+benchmark rises above its RSS after the warm-up call, so it includes
+Pillow/decord allocations (Linux, via /proc/self/clear_refs).
+Baselines are host-specific and not shipped; the check fails until one
+is recorded with --save-baseline.
+The MP4 fixture needs `ffmpeg` on PATH (or the imageio-ffmpeg package);
+without it the extract_frame benchmark is skipped.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import tgutils
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tgutils_baseline.json")
+
+HASHTAGS = [
+    "#срочно", "#происшествия", "#дтп", "#лайфстайл", "#спорт",
+    "#город", "#политика", "#развлечения", "#18+", "#топновости",
+]
+WORDS = (
+    "сегодня вечером в центре города произошло крупное дтп пострадавших нет "
+    "движение по проспекту затруднено водителей просят выбирать пути объезда "
+    "по данным мэрии ремонт моста завершится к концу месяца"
+).split()
+EMOJI = ["🔥", "⚡️", "🚨", "❗️", "👉", "😱", "🚗", "🏙", "✅", "📍"]
+
+
+# Fixtures
+
+def make_post(rng, words=60):
+    parts = []
+    for _ in range(words):
+        word = rng.choice(WORDS)
+        roll = rng.random()
+        if roll < 0.08:
+            word = f"**{word}**"
+        elif roll < 0.12:
+            word = f"__{word}__"
+        elif roll < 0.2:
+            word = f"{word} {rng.choice(EMOJI)}"
+        parts.append(word)
+    tags = " ".join(rng.sample(HASHTAGS, 2))
+    footer = "[Подписаться](https://t.me/example) | __Прислать новость__"
+    return f"{rng.choice(EMOJI)} {' '.join(parts)}\n\n{tags}\n\n{footer}"
+
+
+def make_posts(count=200, seed=1):
+    rng = random.Random(seed)
+    return [make_post(rng, rng.randrange(20, 120)) for _ in range(count)]
+
+
+def make_album(size, rng):
+    group_id = rng.randrange(10**12, 10**13)
+    messages = []
+    for i in range(size):
+        messages.append(types.SimpleNamespace(
+            id=1000 + i,
+            group_id=group_id,
+            date=f"2024-12-01T10:00:{i:02d}+00:00",
+            text=make_post(rng) if i == 0 else "",
+            media={"filename": f"{1000 + i}.webp", "spoiler": False},
+            created_at=time.time() + i,
+        ))
+    # NewMessage + MessageEdited duplicates, as convert_group_to_data sees them
+    return messages + messages[: size // 2]
+
+
+def make_albums(seed=2):
+    rng = random.Random(seed)
+    return [make_album(size, rng) for size in (1, 2, 4, 6, 10)]
+
+
+def make_images(directory):
+    from PIL import Image, ImageDraw, ImageFilter
+
+    rng = random.Random(3)
+    paths = {}
+    for name, (width, height), fmt in (
+        ("photo.jpg", (1280, 960), "JPEG"),
+        ("screenshot.png", (1080, 1920), "PNG"),
+    ):
+        img = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+        draw = ImageDraw.Draw(img)
+        for _ in range(80):
+            x, y = rng.randrange(width), rng.randrange(height)
+            r = rng.randrange(10, width // 5)
+            draw.ellipse((x - r, y - r, x + r, y + r), fill=tuple(rng.randrange(256) for _ in range(3)))
+        if fmt == "JPEG":
+            img = img.filter(ImageFilter.GaussianBlur(1))
+        path = os.path.join(directory, name)
+        img.save(path, fmt)
+        paths[name] = path
+    return paths
+
+
+def find_ffmpeg():
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg:
+        return ffmpeg
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except ImportError:
+        return None
+
+
+def make_video(directory):
+    ffmpeg = find_ffmpeg()
+    if not ffmpeg:
+        return None
+    path = os.path.join(directory, "clip.mp4")
+    subprocess.run(
+        [ffmpeg, "-loglevel", "error", "-y", "-f", "lavfi",
+         "-i", "testsrc2=size=1280x720:rate=25:duration=2",
+         "-pix_fmt", "yuv420p", "-c:v", "libx264", path],
+        check=True,
+    )
+    return path
+
+
+# Benchmarks
+
+def make_fixtures(directory):
+    return {"images": make_images(directory), "video": make_video(directory)}
+
+
+def build_benchmarks(fixtures, directory):
+    posts = make_posts()
+    albums = make_albums()
+    images = fixtures["images"]
+    video = fixtures["video"]
+    out = os.path.join(directory, "out")
+    os.makedirs(out, exist_ok=True)
+
+    benchmarks = {
+        "cleanup_text": lambda: [tgutils.cleanup_text(post, HASHTAGS) for post in posts],
+        "has_valid_hashtag": lambda: [tgutils.has_valid_hashtag(post, HASHTAGS) for post in posts],
+        "remove_after_first_valid_hashtag": lambda: [
+            tgutils.remove_after_first_valid_hashtag(post, HASHTAGS) for post in posts
+        ],
+        "convert_group_to_data": lambda: [tgutils.convert_group_to_data(album) for album in albums],
+    }
+    for name, path in images.items():
+        benchmarks[f"compress_image[{name}]"] = (
+            lambda path=path: tgutils.compress_image(path, os.path.join(out, "fast.webp"))
+        )
+        benchmarks[f"compress_thumbnail[{name}]"] = (
+            lambda path=path: tgutils.compress_thumbnail(path, os.path.join(out, "thumb.webp"))
+        )
+    if video:
+        benchmarks["extract_frame[clip.mp4]"] = (
+            lambda: tgutils.extract_frame(video, os.path.join(out, "preview.webp"))
+        )
+    return benchmarks
+
+
+def measure(func, min_time, min_runs=3):
+    runs = 0
+    started = time.perf_counter()
+    while runs < min_runs or time.perf_counter() - started < min_time:
+        func()
+        runs += 1
+    return runs / (time.perf_counter() - started)
+
+
+def _read_status_kb(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1])
+    raise OSError(f"{field} missing from /proc/self/status")
+
+
+def reset_peak_rss():
+    """Resets the RSS high-water mark (Linux) and returns the current RSS in KB"""
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    return _read_status_kb("VmRSS")
+
+
+def _run_in_child(name, fixtures, directory, min_time, connection):
+    func = build_benchmarks(fixtures, directory)[name]
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    func()  # warm-up: lazy imports and caches shouldn't count as peak memory
+    try:
+        rss_before = reset_peak_rss()
+        ops = measure(func, min_time)
+        peak = _read_status_kb("VmHWM") - rss_before
+    except OSError:
+        # No way to reset the high-water mark: peak since fork, warm-up included
+        ops = measure(func, min_time)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_start
+    connection.send({"ops_per_sec": ops, "peak_memory_kb": max(peak, 0)})
+    connection.close()
+
+
+def run_benchmarks(min_time, only=None):
+    results = {}
+    context = multiprocessing.get_context("fork")
+    with tempfile.TemporaryDirectory() as directory:
+        fixtures = make_fixtures(directory)
+        names = list(build_benchmarks(fixtures, directory))
+        if not any(name.startswith("extract_frame") for name in names):
+            print("extract_frame skipped: no ffmpeg to generate the MP4 fixture")
+        for name in names:
+            if only and not any(pattern in name for pattern in only):
+                continue
+            parent, child = context.Pipe()
+            process = context.Process(target=_run_in_child, args=(name, fixtures, directory, min_time, child))
+            process.start()
+            results[name] = parent.recv()
+            process.join()
+    return results
+
+
+def compare(results, baseline, tolerance, memory_tolerance):
+    regressions = []
+    print(f"{'benchmark':<40}{'ops/sec':>12}{'baseline':>12}{'peak KB':>10}{'baseline':>10}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        status = ""
+        if base:
+            if result["ops_per_sec"] < base["ops_per_sec"] * (1 - tolerance):
+                status = "SLOWER"
+            # small absolute growth is allocator noise
+            elif result["peak_memory_kb"] > max(base["peak_memory_kb"] * (1 + memory_tolerance), base["peak_memory_kb"] + 1024):
+                status = "MORE MEMORY"
+            if status:
+                regressions.append(name)
+        print(
+            f"{name:<40}{result['ops_per_sec']:>12.1f}"
+            f"{base['ops_per_sec'] if base else float('nan'):>12.1f}"
+            f"{result['peak_memory_kb']:>10}"
+            f"{base['peak_memory_kb'] if base else '-':>10}  {status}"
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="Store results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed ops/sec drop (0.2 = 20%%)")
+    parser.add_argument("--memory-tolerance", type=float, default=0.25, help="Allowed peak memory growth")
+    parser.add_argument("--min-time", type=float, default=1.0, help="Seconds per benchmark")
+    parser.add_argument("-k", "--only", action="append", help="Run benchmarks whose name contains this")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.min_time, args.only)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        compare(results, {}, args.tolerance, args.memory_tolerance)
+        print(f"\nBaseline saved to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        compare(results, {}, args.tolerance, args.memory_tolerance)
+        sys.exit(f"\nNo baseline at {args.baseline}, record one with --save-baseline first")
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    regressions = compare(results, baseline, args.tolerance, args.memory_tolerance)
+    if regressions:
+        print(f"\nRegressions: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Size vs. encode time of WebP profiles on a sample corpus.
+
+    python benchmarks/webp_profiles.py --corpus media/images --limit 50
+
+Without --corpus a few synthetic photos are generated in memory.
+The measured megapixels per second can be copied into
+`tgutils.WEBP_MPIXELS_PER_SECOND` to calibrate the profile choice.
+"""
+import argparse
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from PIL import Image, ImageDraw, ImageFilter
+
+import tgutils
+
+
+def synthetic_corpus(sizes=((1280, 720), (1920, 1080), (2560, 1440), (400, 300))):
+    rng = random.Random(42)
+    images = []
+    for width, height in sizes:
+        img = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+        draw = ImageDraw.Draw(img)
+        for _ in range(60):
+            x, y = rng.randrange(width), rng.randrange(height)
+            r = rng.randrange(10, max(width, height) // 6)
+            color = tuple(rng.randrange(256) for _ in range(3))
+            draw.ellipse((x - r, y - r, x + r, y + r), fill=color)
+        img = img.filter(ImageFilter.GaussianBlur(2))
+        noise = Image.effect_noise((width, height), 24).convert("RGB")
+        images.append((f"synthetic_{width}x{height}", Image.blend(img, noise, 0.15)))
+    return images
+
+
+def load_corpus(path, limit):
+    images = []
+    for name in sorted(os.listdir(path))[:limit]:
+        try:
+            with Image.open(os.path.join(path, name)) as img:
+                # prepare_for_webp returns RGB images as is, copy before the file closes
+                images.append((name, tgutils.prepare_for_webp(img).copy()))
+        except OSError:
+            continue
+    return images
+
+
+def encode(img, **options):
+    buffer = io.BytesIO()
+    started = time.process_time()
+    img.save(buffer, format="WEBP", **options)
+    return buffer.tell(), time.process_time() - started
+
+
+def measure(images, options):
+    total_size = total_time = total_mpixels = 0
+    for _, img in images:
+        size, seconds = encode(img, **options)
+        total_size += size
+        total_time += seconds
+        total_mpixels += img.size[0] * img.size[1] / 1_000_000
+    count = len(images)
+    return total_size / count, total_time / count, total_mpixels / max(total_time, 1e-9)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", help="Directory with sample images")
+    parser.add_argument("--limit", type=int, default=30)
+    parser.add_argument("--quality", type=int, default=50)
+    parser.add_argument("--ratio", type=float, default=0.5, help="Scale applied before encoding, as for fastimages")
+    parser.add_argument("--budget", type=float, default=tgutils.WEBP_TIME_BUDGET)
+    args = parser.parse_args()
+
+    images = load_corpus(args.corpus, args.limit) if args.corpus else synthetic_corpus()
+    if not images:
+        sys.exit("No images found")
+    if args.ratio != 1:
+        images = [
+            (name, img.resize((int(img.size[0] * args.ratio), int(img.size[1] * args.ratio)), resample=Image.LANCZOS))
+            for name, img in images
+        ]
+    print(f"{len(images)} images, quality {args.quality}, ratio {args.ratio}\n")
+
+    print(f"{'profile':<22}{'avg KB':>10}{'avg ms':>10}{'Mpx/s':>10}")
+    rates = {}
+    for lossless in (False, True):
+        for method in range(7):
+            options = {"lossless": lossless, "method": method, "quality": 100 if lossless else args.quality}
+            avg_size, avg_time, rate = measure(images, options)
+            if not lossless:
+                rates[method] = round(rate, 1)
+            label = f"{'lossless' if lossless else 'lossy'} method={method}"
+            print(f"{label:<22}{avg_size / 1024:>10.1f}{avg_time * 1000:>10.1f}{rate:>10.1f}")
+
+    print(f"\nProfiles chosen with a {args.budget}s budget:")
+    over_budget = 0
+    for name, img in images:
+        profile = tgutils.choose_webp_profile(*img.size, args.quality, args.budget)
+        size, seconds = encode(img, **profile)
+        status = "OVER BUDGET" if seconds > args.budget else ""
+        over_budget += bool(status)
+        print(f"  {name}: {profile} -> {size / 1024:.1f} KB in {seconds * 1000:.1f} ms  {status}")
+    print(f"{over_budget} of {len(images)} encodes exceeded the budget")
+
+    print(f"\nMeasured WEBP_MPIXELS_PER_SECOND = {dict(sorted(rates.items(), reverse=True))}")
+
+
+if __name__ == "__main__":
+    main()
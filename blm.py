@@ -5,6 +5,8 @@ import logging
 import os
 from TelegramDownloader import MessageDownloader
 import tgutils
+import logutils
+from stalls import StallDetector
 
 logger = logging.getLogger(__name__)
 
@@ -40,6 +42,12 @@ def load_arguments():
         action="store_true",
         help="Run the script without making any calls to API",
     )
+    parser.add_argument(
+        "-b",
+        "--backfill",
+        action="store_true",
+        help="Also load history from start_date in the same process, live updates go first",
+    )
     args = parser.parse_args()
     return args
 
@@ -59,18 +67,23 @@ def get_config_from_arguments(args):
 
 def configure_logger(log_folder="logs"):
     tgutils.create_output_directories(log_folder)
-    logging.basicConfig(
-        # filename=f"{log_folder}/telegram_dler.log",
-        level=logging.INFO,
-        format=f"%(asctime)s - %(name)-25s - {os.path.split(os.getcwd())[1]} - %(levelname)s - %(message)s",
+    logutils.start_queue_logging(
         handlers=[
             logging.FileHandler(f"{log_folder}/telegram_blm.log"),
             logging.StreamHandler(),
         ],
+        level=logging.INFO,
+        fmt=f"%(asctime)s - %(name)-25s - {os.path.split(os.getcwd())[1]} - %(levelname)s - %(message)s",
     )
     logging.getLogger("telethon").setLevel(logging.WARNING)
 
 
+def get_optional_section(config, section):
+    if config.has_section(section):
+        return dict(config[section])
+    return {}
+
+
 async def main():
     configure_logger()
     try:
@@ -80,16 +93,32 @@ async def main():
         print(f"Failed to load config, exiting. Error message: {e}")
         exit()
 
+    stall_detector = StallDetector.from_config(get_optional_section(config, "diagnostics"))
+    if stall_detector:
+        stall_detector.start()
+
     channel = convert_to_number_if_possible(config.get("info", "channel"))
     md = MessageDownloader(
         **config["tg"],
         **config["paths"],
+        **get_optional_section(config, "logging"),
+        **get_optional_section(config, "outbox"),
+        **get_optional_section(config, "download"),
+        **get_optional_section(config, "renditions"),
+        **get_optional_section(config, "history"),
+        **get_optional_section(config, "retention"),
         start_date=config["info"]["start_date"],
         dry=args.dry,
     )
+    backfill = args.backfill
     while True:
         try:
-            await md.get_new_messages(channel)
+            if backfill:
+                # History is loaded once, restarts continue with live updates only
+                backfill = False
+                await md.get_new_messages_with_history(channel)
+            else:
+                await md.get_new_messages(channel)
         except Exception:
             logger.exception("message")
         finally:
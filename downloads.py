@@ -0,0 +1,390 @@
+import os
+import json
+import math
+import heapq
+import asyncio
+import concurrent.futures
+import itertools
+import time
+import logging
+
+from telethon.errors import FileReferenceExpiredError
+from telethon.tl.types import PhotoSize, PhotoCachedSize, PhotoSizeProgressive
+
+logger = logging.getLogger(__name__)
+
+# Telegram serves files in parts of up to 512 KB; parallel ranges are
+# aligned to it so every request stays within one part
+PART_SIZE = 512 * 1024
+# The sidecar is rewritten after this many parts of a range; parts fetched
+# since the last save are downloaded again after a crash
+SAVE_EVERY_PARTS = 8
+
+
+def get_media_size(message):
+    """Size in bytes from message metadata (largest PhotoSize for photos), 0 if unknown"""
+    file = getattr(message, "file", None)
+    return (file and file.size) or 0
+
+
+def get_thumb_size(thumb):
+    """Size in bytes of a photo size or document thumb, 0 if unknown"""
+    if isinstance(thumb, PhotoSizeProgressive):
+        return max(thumb.sizes)
+    if isinstance(thumb, PhotoCachedSize):
+        return len(thumb.bytes)
+    return getattr(thumb, "size", 0) or 0
+
+
+def choose_server_size(sizes, min_width, max_width=None):
+    """
+    Smallest Telegram-provided JPEG size (`photo.sizes` or `document.thumbs`)
+    at least `min_width` wide and narrower than `max_width`, None if there
+    is none. Stripped, vector and video sizes are never picked.
+    """
+    candidates = [
+        size for size in sizes or []
+        if isinstance(size, (PhotoSize, PhotoCachedSize, PhotoSizeProgressive))
+        and size.w >= min_width
+        and (max_width is None or size.w < max_width)
+    ]
+    return min(candidates, key=lambda size: size.w, default=None)
+
+
+class SharedPriority:
+    """
+    Priority of a job that several callers wait on. Raising it moves the
+    job's queued PrioritySlots requests forward.
+    """
+
+    def __init__(self, value):
+        self.value = value
+        self.requeue = []
+
+    def raise_to(self, value):
+        if value >= self.value:
+            return
+        self.value = value
+        for requeue in list(self.requeue):
+            requeue()
+
+
+def priority_value(priority):
+    """Current value of a plain or shared priority"""
+    return priority.value if isinstance(priority, SharedPriority) else priority
+
+
+class PrioritySlots:
+    """
+    Concurrency limiter that hands free slots to the waiter with the lowest
+    priority value first, then the lowest `rank`, FIFO among equals.
+    A SharedPriority is re-queued whenever it is raised.
+    """
+
+    def __init__(self, slots):
+        self.free = slots
+        self.waiters = []
+        self._counter = itertools.count()
+
+    async def acquire(self, priority, rank=0):
+        if self.free > 0 and not self.waiters:
+            self.free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+
+        def push():
+            # Entries left behind by a raise are skipped by release(), their future is done
+            heapq.heappush(
+                self.waiters, (priority_value(priority), rank, next(self._counter), future)
+            )
+
+        push()
+        if isinstance(priority, SharedPriority):
+            priority.requeue.append(push)
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Slot was handed over right before cancellation, pass it on
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        finally:
+            if isinstance(priority, SharedPriority):
+                priority.requeue.remove(push)
+
+    def release(self):
+        while self.waiters:
+            _, _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.free += 1
+
+
+class RateLimiter:
+    """Global units-per-second budget (bytes, requests, ...); 0 means unlimited"""
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.next_free = 0.0
+
+    async def consume(self, size):
+        if not self.rate:
+            return
+        now = time.monotonic()
+        self.next_free = max(self.next_free, now)
+        delay = self.next_free - now
+        self.next_free += size / self.rate
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller runs the
+    coroutine, callers arriving while it runs await the same result.
+    A cancelled caller doesn't cancel the work for the others.
+
+    With `priority`, the coroutine gets a SharedPriority as its `priority`
+    argument, raised to the most urgent priority among its callers.
+    """
+
+    def __init__(self):
+        self.in_flight = {}
+
+    async def run(self, key, coroutine_func, *args, priority=None):
+        flight = self.in_flight.get(key)
+        if flight is None:
+            shared = None if priority is None else SharedPriority(priority)
+            kwargs = {} if shared is None else {"priority": shared}
+            task = asyncio.ensure_future(coroutine_func(*args, **kwargs))
+            flight = self.in_flight[key] = (task, shared)
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        else:
+            task, shared = flight
+            logger.debug(f"Joining in-flight {key}")
+            if shared is not None and priority is not None:
+                shared.raise_to(priority)
+        return await asyncio.shield(task)
+
+
+class PartialDownload:
+    """
+    `<path>.part` file plus a `<path>.part.json` sidecar that records which
+    parts of each byte range are already on disk and which document they
+    belong to, so an interrupted download continues where it stopped.
+    """
+
+    def __init__(self, path, message, size, connections):
+        self.path = path
+        self.part_path = f"{path}.part"
+        self.sidecar_path = f"{path}.part.json"
+        self.size = size
+
+        document = message.document
+        self.document_info = {
+            "document_id": document.id,
+            "access_hash": document.access_hash,
+            "file_reference": (document.file_reference or b"").hex(),
+            "size": size,
+            "part_size": PART_SIZE,
+        }
+        self.ranges = self._load() or self._create(connections)
+
+    def _load(self):
+        if not (os.path.exists(self.part_path) and os.path.exists(self.sidecar_path)):
+            return None
+        try:
+            with open(self.sidecar_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if state.get("document_id") != self.document_info["document_id"] or any(
+            state.get(key) != self.document_info[key] for key in ("size", "part_size")
+        ):
+            logger.info(f"Discarding stale partial download {self.part_path}")
+            return None
+        logger.info(f"Resuming partial download {self.part_path}")
+        return state["ranges"]
+
+    def _create(self, connections):
+        parts = math.ceil(self.size / PART_SIZE)
+        parts_per_connection = math.ceil(parts / connections)
+        with open(self.part_path, "wb") as f:
+            f.truncate(self.size)
+        ranges = [
+            # [first part, part count, parts done]
+            [first, min(parts_per_connection, parts - first), 0]
+            for first in range(0, parts, parts_per_connection)
+        ]
+        self.ranges = ranges
+        self.save()
+        return ranges
+
+    @property
+    def completed_bytes(self):
+        return min(self.size, sum(done for _, _, done in self.ranges) * PART_SIZE)
+
+    def snapshot(self):
+        return json.dumps({**self.document_info, "ranges": self.ranges})
+
+    def write_sidecar(self, snapshot):
+        tmp_path = f"{self.sidecar_path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(snapshot)
+        os.replace(tmp_path, self.sidecar_path)
+
+    def save(self):
+        self.write_sidecar(self.snapshot())
+
+    def finish(self):
+        os.replace(self.part_path, self.path)
+        os.remove(self.sidecar_path)
+
+    @staticmethod
+    def discard(path):
+        for partial_path in (f"{path}.part", f"{path}.part.json"):
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+
+
+class DownloadScheduler:
+    """
+    Runs all media downloads under one concurrency and bandwidth budget.
+    Free slots go to the lowest `priority` first (live before backfill),
+    then to smaller files, so album photos are not stuck behind a large
+    video. Documents above `resumable_threshold` bytes are fetched in
+    parts into a resumable `.part` file, using several byte ranges in parallel
+    above `parallel_threshold`.
+    """
+
+    def __init__(
+        self,
+        concurrency=3,
+        parallel_threshold=20 * 1024 * 1024,
+        connections=4,
+        bytes_per_second=0,
+        resumable_threshold=5 * 1024 * 1024,
+        retries=3,
+    ):
+        self.slots = PrioritySlots(int(concurrency))
+        self.parallel_threshold = int(parallel_threshold)
+        self.connections = int(connections)
+        self.bandwidth = RateLimiter(int(bytes_per_second or 0))
+        self.resumable_threshold = int(resumable_threshold)
+        self.retries = int(retries)
+        # Part writes, sidecar saves and closes of all resumable downloads
+        # run here in submission order, off the event loop
+        self.writer = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="download-writer"
+        )
+
+    async def download(self, message, file=None, priority=0, thumb=None):
+        """
+        Same contract as `message.download_media(file, thumb=thumb)`: returns
+        the saved path or None
+        """
+        size = get_thumb_size(thumb) if thumb else get_media_size(message)
+        await self.slots.acquire(priority, size)
+        try:
+            if thumb:
+                await self.bandwidth.consume(size)
+                return await message.download_media(file=file, thumb=thumb)
+            if message.document and size >= self.resumable_threshold:
+                path = file or f"{message.id}{message.file.ext or ''}"
+                return await self._download_resumable(message, size, path)
+            await self.bandwidth.consume(size)
+            return await message.download_media(file=file)
+        finally:
+            self.slots.release()
+
+    async def _download_resumable(self, message, size, path):
+        """
+        Falls back to a plain `download_media()` once all retries failed.
+        An expired file reference is renewed by fetching the message again.
+        """
+        connections = self.connections if size >= self.parallel_threshold else 1
+        for attempt in range(1, self.retries + 1):
+            partial = await asyncio.to_thread(
+                PartialDownload, path, message, size, max(connections, 1)
+            )
+            try:
+                await self._fetch_ranges(message, partial)
+                await asyncio.to_thread(partial.finish)
+                logger.info(f"Downloaded {size} bytes for message {message.id} to {path}")
+                return path
+            except Exception as e:
+                logger.warning(
+                    f"Download of message {message.id} interrupted at "
+                    f"{partial.completed_bytes}/{size} bytes (attempt {attempt}): {e}"
+                )
+                if isinstance(e, FileReferenceExpiredError):
+                    message = await self._refetch(message)
+                    if message is None:
+                        await asyncio.to_thread(PartialDownload.discard, path)
+                        return None
+                await asyncio.sleep(attempt)
+
+        logger.warning(f"Falling back to a plain download for message {message.id}")
+        try:
+            await self.bandwidth.consume(size)
+            result = await message.download_media(file=path)
+        except Exception as e:
+            logger.warning(f"Download of message {message.id} failed: {e}")
+            # .part and sidecar stay on disk, the next attempt resumes from them
+            return None
+        if result:
+            await asyncio.to_thread(PartialDownload.discard, path)
+        return result
+
+    @staticmethod
+    async def _refetch(message):
+        """The message with a fresh file reference, None if it was deleted"""
+        fresh = await message.client.get_messages(message.chat_id, ids=message.id)
+        if fresh is None or fresh.document is None:
+            logger.info(f"Message {message.id} is gone, dropping its partial download")
+            return None
+        return fresh
+
+    async def _fetch_ranges(self, message, partial):
+        """
+        Fetches the unfinished parts of every range concurrently. Disk writes
+        and sidecar saves go to the writer thread, never blocking the loop.
+        """
+        loop = asyncio.get_running_loop()
+
+        def write(func, *args):
+            return loop.run_in_executor(self.writer, func, *args)
+
+        async def fetch_range(state, fd):
+            first, count, done = state
+            if done >= count:
+                return
+            offset = (first + done) * PART_SIZE
+            async for chunk in message.client.iter_download(
+                message.document,
+                offset=offset,
+                limit=count - done,
+                request_size=PART_SIZE,
+                file_size=partial.size,
+            ):
+                await self.bandwidth.consume(len(chunk))
+                await write(os.pwrite, fd, chunk, offset)
+                offset += len(chunk)
+                state[2] += 1
+                if state[2] % SAVE_EVERY_PARTS == 0:
+                    await write(partial.write_sidecar, partial.snapshot())
+
+        fd = await write(os.open, partial.part_path, os.O_WRONLY)
+        tasks = [asyncio.create_task(fetch_range(state, fd)) for state in partial.ranges]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            # Queued behind any write a cancelled range left in flight
+            write(partial.write_sidecar, partial.snapshot())
+            await write(os.close, fd)
@@ -5,6 +5,8 @@ import logging
 
 from TelegramDownloader import MessageDownloader
 import tgutils
+import logutils
+from stalls import StallDetector
 
 def convert_to_number_if_possible(a, just_try=True):
     try:
@@ -57,18 +59,23 @@ def get_config_from_arguments(args):
 
 def configure_logger(log_folder="logs"):
     tgutils.create_output_directories(log_folder)
-    logging.basicConfig(
-        # filename=f"{log_folder}/telegram_dler.log",
-        level=logging.INFO,
-        format="%(asctime)s - %(name)-25s - %(levelname)s - %(message)s",
+    logutils.start_queue_logging(
         handlers=[
             logging.FileHandler(f"{log_folder}/telegram_load.log"),
             logging.StreamHandler(),
         ],
+        level=logging.INFO,
+        fmt="%(asctime)s - %(name)-25s - %(levelname)s - %(message)s",
     )
     logging.getLogger("telethon").setLevel(logging.WARNING)
 
 
+def get_optional_section(config, section):
+    if config.has_section(section):
+        return dict(config[section])
+    return {}
+
+
 async def main():
     configure_logger()
     try:
@@ -78,10 +85,20 @@ async def main():
         print(f"Failed to load config, exiting. Error message: {e}")
         exit()
 
+    stall_detector = StallDetector.from_config(get_optional_section(config, "diagnostics"))
+    if stall_detector:
+        stall_detector.start()
+
     channel = convert_to_number_if_possible(config.get("info", "channel"))
     md = MessageDownloader(
         **config["tg"],
         **config["paths"],
+        **get_optional_section(config, "logging"),
+        **get_optional_section(config, "outbox"),
+        **get_optional_section(config, "download"),
+        **get_optional_section(config, "renditions"),
+        **get_optional_section(config, "history"),
+        **get_optional_section(config, "retention"),
         start_date=config["info"]["start_date"],
         dry=args.dry,
     )
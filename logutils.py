@@ -0,0 +1,79 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import itertools
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener thread.
+    The stock `prepare()` renders the message in the calling thread,
+    which is exactly the work we want to keep off the event loop.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def start_queue_logging(handlers, level=logging.INFO, fmt=None):
+    """
+    Routes the root logger through an in-memory queue drained by a
+    background thread that owns the real (file/stream) `handlers`.
+    Returns the started QueueListener; it is stopped automatically at exit.
+    """
+    formatter = logging.Formatter(fmt)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        log_queue, *handlers, respect_handler_level=True
+    )
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(level)
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+class TruncatedRepr:
+    """Defers `str(obj)` until the record is formatted and caps its length."""
+
+    __slots__ = ("obj", "max_length")
+
+    def __init__(self, obj, max_length=None):
+        self.obj = obj
+        self.max_length = max_length
+
+    def __str__(self):
+        text = str(self.obj)
+        if self.max_length and len(text) > self.max_length:
+            return f"{text[:self.max_length]}... [{len(text) - self.max_length} chars truncated]"
+        return text
+
+
+class EventLogSampler:
+    """
+    Logs every `sample_rate`-th raw event dump (1 logs all, 0 disables),
+    truncated to `max_length` characters.
+    """
+
+    def __init__(self, logger, sample_rate=1, max_length=None, level=logging.INFO):
+        self.logger = logger
+        self.sample_rate = int(sample_rate)
+        self.max_length = int(max_length) if max_length else None
+        self.level = level
+        self._counter = itertools.count()
+
+    def __call__(self, event):
+        if self.sample_rate <= 0 or not self.logger.isEnabledFor(self.level):
+            return
+        if next(self._counter) % self.sample_rate:
+            return
+        self.logger.log(self.level, "%s", TruncatedRepr(event, self.max_length))
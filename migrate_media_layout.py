@@ -0,0 +1,106 @@
+import argparse
+import configparser
+import logging
+import os
+
+import tgutils
+from renditions import RenditionCache
+
+logger = logging.getLogger(__name__)
+
+MEDIA_PATHS = ("image_path", "video_path", "fastimage_path", "thumbnail_path")
+
+
+def load_arguments():
+    parser = argparse.ArgumentParser(
+        description="Move existing media between the flat and the sharded directory layout in place."
+    )
+    parser.add_argument("-c", "--config", required=True, help="Path to the .ini configuration file")
+    parser.add_argument(
+        "--to", choices=("sharded", "flat"), default="sharded", help="Target layout"
+    )
+    parser.add_argument(
+        "-d",
+        "--dry",
+        action="store_true",
+        help="Only print what would be moved",
+    )
+    return parser.parse_args()
+
+
+def load_config(filename):
+    config = configparser.ConfigParser(
+        interpolation=configparser.ExtendedInterpolation()
+    )
+    config.read(filename)
+    return config
+
+
+def iter_media_files(directory):
+    """Files directly in `directory` and in its shard subdirectories"""
+    directories = [directory]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    directories.append(entry.path)
+                elif entry.is_file():
+                    yield entry.path
+
+
+def remove_empty_directories(directory):
+    for root, _, _ in sorted(os.walk(directory), key=lambda item: -len(item[0])):
+        if root != directory and not os.listdir(root):
+            os.rmdir(root)
+
+
+def migrate_directory(directory, sharded, renditions=None, dry=False):
+    moved = skipped = 0
+    for path in list(iter_media_files(directory)):
+        target = tgutils.media_file_path(directory, path, sharded)
+        if target == path:
+            continue
+        if os.path.exists(target):
+            logger.warning(f"Not moving {path}: {target} already exists")
+            skipped += 1
+            continue
+        if not dry:
+            tgutils.create_output_directories(os.path.dirname(target))
+            # Same filesystem, so this is a metadata-only rename
+            os.rename(path, target)
+            if renditions:
+                renditions.rename(path, target)
+        moved += 1
+        if moved % 10000 == 0:
+            logger.info(f"{directory}: moved {moved} files")
+    if not (sharded or dry):
+        remove_empty_directories(directory)
+    logger.info(f"{directory}: moved {moved} files, skipped {skipped}")
+    return moved, skipped
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    args = load_arguments()
+    config = load_config(args.config)
+    paths = config["paths"]
+    sharded = args.to == "sharded"
+
+    renditions_path = (
+        config.get("renditions", "rendition_cache_path", fallback=None)
+        or os.path.join(os.path.dirname(os.path.abspath(paths["image_path"])), "renditions.sqlite")
+    )
+    renditions = RenditionCache(renditions_path) if os.path.exists(renditions_path) else None
+
+    for key in MEDIA_PATHS:
+        directory = paths.get(key)
+        if directory and os.path.isdir(directory):
+            migrate_directory(directory, sharded, renditions, args.dry)
+
+    if renditions:
+        renditions.close()
+    logger.info(f"Done. Set `media_layout = {args.to}` in [paths] before restarting the daemons.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import json
+import sqlite3
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    """
+    On-disk queue of converted payloads waiting for the API to acknowledge them.
+    Entries are keyed by `groupID`, so re-publishing the same post (e.g. after
+    an edit) replaces the pending payload instead of queueing a second one.
+
+    Retries back off exponentially with the number of attempts. Entries the
+    API rejected for good, that failed `max_attempts` times, or that overflow
+    `max_entries` are moved to the `outbox_dead` table and never sent again
+    on their own. Dead entries are kept for `dead_max_age_days`, at most
+    `max_dead_entries` of them.
+    """
+
+    # Retry delays stop doubling after this many attempts
+    MAX_BACKOFF_SHIFT = 6
+
+    def __init__(
+        self,
+        path,
+        max_entries=10000,
+        compact_every=500,
+        max_attempts=10,
+        max_dead_entries=10000,
+        dead_max_age_days=30,
+    ):
+        self.path = path
+        self.max_entries = int(max_entries)
+        self.max_attempts = int(max_attempts)
+        self.max_dead_entries = int(max_dead_entries)
+        self.dead_max_age = float(dead_max_age_days) * 24 * 3600
+        self.compact_every = int(compact_every)
+        self._acks_since_compact = 0
+
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT NOT NULL UNIQUE,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_attempt REAL NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0
+            )"""
+        )
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS outbox_dead (
+                key TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                failed_at REAL NOT NULL,
+                attempts INTEGER NOT NULL,
+                reason TEXT NOT NULL
+            )"""
+        )
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def put(self, payload: dict):
+        key = str(payload["groupID"])
+        self.db.execute(
+            """INSERT INTO outbox (key, payload, created_at) VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                payload = excluded.payload, last_attempt = 0, attempts = 0""",
+            (key, json.dumps(payload, ensure_ascii=False), time.time()),
+        )
+        # A new version of a dead post gets a fresh chance
+        self.db.execute("DELETE FROM outbox_dead WHERE key = ?", (key,))
+        self._enforce_limit()
+        return key
+
+    def mark_attempt(self, key):
+        """Returns the number of attempts including this one"""
+        self.db.execute(
+            "UPDATE outbox SET last_attempt = ?, attempts = attempts + 1 WHERE key = ?",
+            (time.time(), key),
+        )
+        row = self.db.execute("SELECT attempts FROM outbox WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def dead_letter(self, key, reason):
+        """Moves an entry out of the retry queue into `outbox_dead`"""
+        self._move_to_dead("key = ?", (key,), reason)
+        logger.warning(f"Outbox entry {key} moved to dead letters: {reason}")
+
+    def _move_to_dead(self, condition, params, reason):
+        self.db.execute("BEGIN")
+        try:
+            self.db.execute(
+                f"""INSERT OR REPLACE INTO outbox_dead
+                SELECT key, payload, created_at, ?, attempts, ? FROM outbox WHERE {condition}""",
+                (time.time(), reason, *params),
+            )
+            self.db.execute(f"DELETE FROM outbox WHERE {condition}", params)
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+
+    def ack(self, key):
+        self.db.execute("DELETE FROM outbox WHERE key = ?", (key,))
+        self._acks_since_compact += 1
+        if self._acks_since_compact >= self.compact_every:
+            self.compact()
+
+    def pending(self, retry_after=0, limit=None):
+        """
+        Returns up to `limit` (key, payload) pairs, oldest first, whose last
+        attempt was at least `retry_after` seconds ago, doubled for every
+        failed attempt after the first
+        """
+        rows = self.db.execute(
+            """SELECT key, payload FROM outbox
+            WHERE last_attempt + ? * (1 << MIN(MAX(attempts - 1, 0), ?)) <= ?
+            ORDER BY id LIMIT ?""",
+            (retry_after, self.MAX_BACKOFF_SHIFT, time.time(), -1 if limit is None else int(limit)),
+        ).fetchall()
+        return [(key, json.loads(payload)) for key, payload in rows]
+
+    def _enforce_limit(self):
+        overflow = len(self) - self.max_entries
+        if overflow > 0:
+            logger.warning(f"Outbox is full, moving {overflow} oldest entries to dead letters")
+            self._move_to_dead(
+                "id IN (SELECT id FROM outbox ORDER BY id LIMIT ?)",
+                (overflow,),
+                "outbox full",
+            )
+            # No acks, no compaction: keep the dead letters bounded here too
+            self._trim_dead()
+
+    def _trim_dead(self):
+        expired = self.db.execute(
+            "DELETE FROM outbox_dead WHERE failed_at < ?", (time.time() - self.dead_max_age,)
+        ).rowcount
+        overflow = self.db.execute(
+            """DELETE FROM outbox_dead WHERE key IN (
+                SELECT key FROM outbox_dead ORDER BY failed_at DESC LIMIT -1 OFFSET ?
+            )""",
+            (self.max_dead_entries,),
+        ).rowcount
+        if expired or overflow:
+            logger.warning(f"Dropped {expired + overflow} dead outbox entries")
+
+    def compact(self):
+        self._acks_since_compact = 0
+        self._trim_dead()
+        self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.db.execute("PRAGMA incremental_vacuum")
+
+    def close(self):
+        self.compact()
+        self.db.close()
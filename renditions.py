@@ -0,0 +1,133 @@
+import os
+import asyncio
+import json
+import sqlite3
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class RenditionCache:
+    """
+    Remembers which source file (path, size, mtime) and which parameters
+    every generated rendition (preview, fastimage, thumbnail) was built from.
+    A rendition is regenerated only when its output is missing or empty,
+    the source changed, or the parameters differ. Outputs that predate the
+    cache are adopted as they are.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS renditions (
+                output_path TEXT PRIMARY KEY,
+                source_path TEXT NOT NULL,
+                source_size INTEGER NOT NULL,
+                source_mtime_ns INTEGER NOT NULL,
+                params TEXT NOT NULL
+            )"""
+        )
+
+    @staticmethod
+    def _key(source_path, output_path, params):
+        source_stat = os.stat(source_path)
+        return (
+            os.path.abspath(output_path),
+            os.path.abspath(source_path),
+            source_stat.st_size,
+            source_stat.st_mtime_ns,
+            json.dumps(params, sort_keys=True),
+        )
+
+    def is_fresh(self, source_path, output_path, params):
+        """
+        An output without a cache entry (e.g. generated before the cache
+        existed) counts as fresh if it is non-empty and newer than its
+        source; it is recorded with `params` from then on.
+        """
+        try:
+            output_stat = os.stat(output_path)
+            if output_stat.st_size == 0:
+                return False
+            key = self._key(source_path, output_path, params)
+        except OSError:
+            return False
+        row = self.db.execute(
+            """SELECT source_path, source_size, source_mtime_ns, params
+            FROM renditions WHERE output_path = ?""",
+            (key[0],),
+        ).fetchone()
+        if row is None and output_stat.st_mtime_ns >= key[3]:
+            self.db.execute("INSERT OR REPLACE INTO renditions VALUES (?, ?, ?, ?, ?)", key)
+            return True
+        return row == key[1:]
+
+    def record(self, source_path, output_path, params):
+        self.db.execute(
+            "INSERT OR REPLACE INTO renditions VALUES (?, ?, ?, ?, ?)",
+            self._key(source_path, output_path, params),
+        )
+
+    def rename(self, old_path, new_path):
+        """Keeps entries valid when a source or rendition file is moved"""
+        old_path, new_path = os.path.abspath(old_path), os.path.abspath(new_path)
+        self.db.execute(
+            "UPDATE OR REPLACE renditions SET output_path = ? WHERE output_path = ?",
+            (new_path, old_path),
+        )
+        self.db.execute(
+            "UPDATE renditions SET source_path = ? WHERE source_path = ?",
+            (new_path, old_path),
+        )
+
+    def forget(self, output_path):
+        self.db.execute(
+            "DELETE FROM renditions WHERE output_path = ?",
+            (os.path.abspath(output_path),),
+        )
+
+    @staticmethod
+    def _cache_params(render_func, variant, params):
+        cache_params = {"render": render_func.__name__, **params}
+        if variant:
+            cache_params["variant"] = variant
+        return cache_params
+
+    def is_rendered(self, render_func, source_path, output_path, variant=None, **params):
+        """Whether `render` would skip these arguments as up to date"""
+        return self.is_fresh(
+            source_path, output_path, self._cache_params(render_func, variant, params)
+        )
+
+    async def render(
+        self, render_func, source_path, output_path, run=None, variant=None, fetch_source=None, **params
+    ):
+        """
+        Runs `render_func(source_path, output_path, **params)` unless a fresh
+        rendition exists. `run(render_func, *args, **kwargs)` is awaited to do
+        the work, by default in a thread.
+
+        `fetch_source()`, awaited only when the rendition is stale, returns a
+        temporary stand-in for `source_path` (e.g. a server-side thumbnail)
+        that is rendered from and removed afterwards. `variant` names how the
+        rendition was produced and is part of its cache entry.
+        """
+        cache_params = self._cache_params(render_func, variant, params)
+        if self.is_fresh(source_path, output_path, cache_params):
+            logger.debug(f"Rendition {output_path} is up to date")
+            return output_path
+        run = run or asyncio.to_thread
+        render_source = await fetch_source() if fetch_source else source_path
+        try:
+            result = await run(render_func, render_source, output_path, **params)
+        finally:
+            if render_source != source_path and os.path.exists(render_source):
+                os.remove(render_source)
+        self.record(source_path, result or output_path, cache_params)
+        return result or output_path
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,162 @@
+import argparse
+import configparser
+import asyncio
+import logging
+import os
+import time
+
+import aiohttp
+
+import tgutils
+import logutils
+from outbox import Outbox
+
+logger = logging.getLogger(__name__)
+
+
+def load_arguments():
+    parser = argparse.ArgumentParser(
+        description="Re-publish exported messages to the API without touching Telegram."
+    )
+    parser.add_argument("-c", "--config", required=True, help="Path to the .ini configuration file")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("-e", "--export", help="Path to a {channel}.json export written by load_history")
+    source.add_argument("-o", "--outbox", help="Path to an outbox .sqlite file")
+    parser.add_argument("-j", "--concurrency", type=int, default=16, help="Requests in flight")
+    parser.add_argument("-b", "--batch-size", type=int, default=500, help="Items read per batch")
+    parser.add_argument(
+        "--allow-missing",
+        action="store_true",
+        help="Publish items even if their media files are missing",
+    )
+    parser.add_argument(
+        "-d",
+        "--dry",
+        action="store_true",
+        help="Only check the media files, don't make any calls to API",
+    )
+    return parser.parse_args()
+
+
+def load_config(filename):
+    config = configparser.ConfigParser(
+        interpolation=configparser.ExtendedInterpolation()
+    )
+    config.read(filename)
+    return config
+
+
+def configure_logger(log_folder="logs"):
+    tgutils.create_output_directories(log_folder)
+    logutils.start_queue_logging(
+        handlers=[
+            logging.FileHandler(f"{log_folder}/telegram_republish.log"),
+            logging.StreamHandler(),
+        ],
+        level=logging.INFO,
+        fmt="%(asctime)s - %(name)-25s - %(levelname)s - %(message)s",
+    )
+
+
+def get_missing_media(item, paths):
+    """Returns the media files referenced by `item` that don't exist on disk"""
+    missing = []
+    for media in item.get("media") or []:
+        if not media:
+            continue
+        filename = media["filename"]
+        if not any(
+            path and tgutils.find_media_file(path, filename)
+            for path in (paths.get("image_path"), paths.get("video_path"))
+        ):
+            missing.append(filename)
+        rendition = tgutils.generate_new_file_path("", media.get("preview") or filename)
+        for key in ("fastimage_path", "thumbnail_path"):
+            if paths.get(key) and not tgutils.find_media_file(paths[key], rendition):
+                missing.append(os.path.join(paths[key], rendition))
+    return missing
+
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Republisher:
+    def __init__(self, create_url, paths, concurrency, allow_missing=False, dry=False):
+        self.create_url = create_url
+        self.paths = paths
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.allow_missing = allow_missing
+        self.dry = dry
+        self.stats = {"sent": 0, "failed": 0, "skipped": 0}
+
+    async def publish(self, session, key, item, on_success=None):
+        missing = get_missing_media(item, self.paths)
+        if missing:
+            logger.warning(f"Item {key} is missing media: {', '.join(missing)}")
+            if not self.allow_missing:
+                self.stats["skipped"] += 1
+                return
+        if self.dry:
+            self.stats["sent"] += 1
+            return
+        async with self.semaphore:
+            ok = await tgutils.send_to_api(self.create_url, item, session)
+        if ok:
+            self.stats["sent"] += 1
+            if on_success:
+                on_success(key)
+        else:
+            self.stats["failed"] += 1
+
+    async def run(self, items, batch_size, on_success=None):
+        started = time.monotonic()
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            for batch in iter_batches(items, batch_size):
+                await asyncio.gather(
+                    *(self.publish(session, key, item, on_success) for key, item in batch)
+                )
+                logger.info(f"Progress: {self.stats} in {time.monotonic() - started:.1f}s")
+        return self.stats
+
+
+async def main():
+    configure_logger()
+    args = load_arguments()
+    config = load_config(args.config)
+    paths = dict(config["paths"])
+
+    republisher = Republisher(
+        paths["create_url"],
+        paths,
+        args.concurrency,
+        allow_missing=args.allow_missing,
+        dry=args.dry,
+    )
+
+    if args.export:
+        items = (
+            (item.get("groupID"), item)
+            for item in tgutils.iter_messages_from_file(args.export)
+        )
+        stats = await republisher.run(items, args.batch_size)
+    else:
+        outbox = Outbox(args.outbox)
+        on_success = None if args.dry else outbox.ack
+        stats = await republisher.run(outbox.pending(), args.batch_size, on_success)
+        outbox.close()
+
+    logger.info(f"Done: {stats}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,238 @@
+import os
+import time
+import ctypes
+import pathlib
+import concurrent.futures
+import asyncio
+import logging
+import platform
+
+import tgutils
+
+logger = logging.getLogger(__name__)
+
+# ioprio_set(2) syscall numbers, the stdlib has no wrapper for it
+IOPRIO_SET_SYSCALLS = {"x86_64": 251, "aarch64": 30}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+
+def set_idle_io_priority():
+    """
+    Moves the calling thread to the idle I/O scheduling class (Linux only,
+    best effort). I/O priority is per thread, so this doesn't affect the loop.
+    """
+    syscall_number = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if syscall_number is None:
+        return False
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.syscall(
+            syscall_number, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+        ) == 0
+    except (OSError, AttributeError):
+        return False
+
+
+class MediaRetention:
+    """
+    Removes media of deleted messages and keeps a city's media directories
+    within age (`max_age_days`) and size (`max_bytes`) quotas. Renditions
+    (fastimages, thumbnails) without a source image are deleted as orphans.
+    Quotas of 0 are disabled. Messages evicted by a quota are unpublished
+    before their media is removed. Resumable downloads (`.part` files) in
+    `partial_path` are removed with their message or once abandoned.
+    """
+
+    # Renditions younger than this may still be in the middle of being generated
+    ORPHAN_GRACE_SECONDS = 3600
+    # Partial downloads untouched for this long are never going to be resumed
+    PARTIAL_MAX_AGE_SECONDS = 7 * 24 * 3600
+    PARTIAL_SUFFIXES = (".part", ".part.json", ".part.json.tmp")
+
+    def __init__(
+        self,
+        image_path,
+        video_path,
+        fastimage_path=None,
+        thumbnail_path=None,
+        max_age_days=0,
+        max_bytes=0,
+        throttle=0.005,
+        partial_path=None,
+    ):
+        self.partial_path = partial_path
+        self.source_paths = [path for path in (image_path, video_path) if path]
+        self.rendition_paths = [path for path in (fastimage_path, thumbnail_path) if path]
+        self.max_age = float(max_age_days or 0) * 24 * 3600
+        self.max_bytes = int(max_bytes or 0)
+        self.throttle = throttle
+        # Dedicated thread, so the idle I/O class doesn't leak into shared executors
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="retention", initializer=set_idle_io_priority
+        )
+        # Media of deleted messages has its own thread, so it never waits behind
+        # a long throttled `compact()` pass
+        self.deletions = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="retention-delete"
+        )
+
+    def _scan(self, paths):
+        """
+        Returns {message_id: [(path, size, mtime), ...]} for files named
+        `{message_id}.*`, in both the flat and the sharded layout
+        """
+        files = {}
+        directories = [path for path in paths if os.path.isdir(path)]
+        while directories:
+            with os.scandir(directories.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        directories.append(entry.path)
+                        continue
+                    # Hidden files are renditions being written
+                    if not entry.is_file() or entry.name.startswith("."):
+                        continue
+                    stat = entry.stat()
+                    message_id = entry.name.split(".", 1)[0]
+                    files.setdefault(message_id, []).append(
+                        (entry.path, stat.st_size, stat.st_mtime)
+                    )
+        return files
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+        finally:
+            if self.throttle:
+                time.sleep(self.throttle)
+
+    def media_files(self, message_id):
+        files = []
+        for path in self.source_paths + self.rendition_paths:
+            for directory in (path, os.path.join(path, tgutils.shard_subdir(str(message_id)))):
+                files.extend(str(file) for file in pathlib.Path(directory).glob(f"{message_id}.*"))
+        if self.partial_path:
+            files.extend(
+                str(file) for file in pathlib.Path(self.partial_path).glob(f"{message_id}.*.part*")
+            )
+        return files
+
+    def remove_stale_partials(self):
+        if not (self.partial_path and os.path.isdir(self.partial_path)):
+            return 0
+        now = time.time()
+        removed = 0
+        with os.scandir(self.partial_path) as entries:
+            for entry in entries:
+                if (
+                    entry.name.endswith(self.PARTIAL_SUFFIXES)
+                    and entry.is_file()
+                    and now - entry.stat().st_mtime > self.PARTIAL_MAX_AGE_SECONDS
+                    and self._remove(entry.path)
+                ):
+                    removed += 1
+        if removed:
+            logger.info(f"Removed {removed} abandoned partial download files")
+        return removed
+
+    def remove_message_media(self, message_id):
+        removed = [path for path in self.media_files(message_id) if self._remove(path)]
+        if removed:
+            logger.info(f"Removed media of deleted message {message_id}: {removed}")
+        return removed
+
+    def compact(self):
+        """
+        Removes abandoned partial downloads and orphaned renditions. Returns
+        [(message_id, paths), ...] of the messages over quota, oldest first;
+        `run` removes them once they are unpublished.
+        """
+        self.remove_stale_partials()
+        if not (self.max_age or self.max_bytes):
+            return []
+
+        now = time.time()
+        sources = self._scan(self.source_paths)
+        renditions = self._scan(self.rendition_paths)
+        removed = 0
+
+        for message_id, files in renditions.items():
+            if message_id in sources:
+                continue
+            for path, _, mtime in files:
+                if now - mtime > self.ORPHAN_GRACE_SECONDS and self._remove(path):
+                    removed += 1
+        if removed:
+            logger.info(f"Removed {removed} orphaned renditions")
+
+        # Oldest message first, by its newest file
+        messages = sorted(
+            (
+                max(mtime for _, _, mtime in files),
+                sum(size for _, size, _ in files + renditions.get(message_id, [])),
+                message_id,
+            )
+            for message_id, files in sources.items()
+        )
+        total_bytes = sum(size for _, size, _ in messages)
+
+        evictions = []
+        for mtime, size, message_id in messages:
+            too_old = self.max_age and now - mtime > self.max_age
+            too_big = self.max_bytes and total_bytes > self.max_bytes
+            if not (too_old or too_big):
+                break
+            paths = [path for path, _, _ in sources[message_id] + renditions.get(message_id, [])]
+            evictions.append((message_id, paths))
+            total_bytes -= size
+        return evictions
+
+    def _remove_files(self, paths):
+        return sum(1 for path in paths if self._remove(path))
+
+    def remove_message_media_in_background(self, message_id):
+        """Schedules `remove_message_media` without waiting for it, failures are logged"""
+        def log_failure(future):
+            if future.exception():
+                logger.error(
+                    f"Failed to remove media of deleted message {message_id}",
+                    exc_info=future.exception(),
+                )
+
+        future = self.deletions.submit(self.remove_message_media, message_id)
+        future.add_done_callback(log_failure)
+        return future
+
+    async def _evict(self, evictions, unpublish=None):
+        """
+        Removes the media of evicted messages. With `unpublish`, a message's
+        media is only removed once `await unpublish(message_id)` confirmed
+        that the site no longer serves its post.
+        """
+        loop = asyncio.get_running_loop()
+        removed = kept = 0
+        for message_id, paths in evictions:
+            if unpublish and not await unpublish(message_id):
+                kept += 1
+                continue
+            removed += await loop.run_in_executor(self.executor, self._remove_files, paths)
+        logger.info(
+            f"Retention pass removed {removed} files of {len(evictions) - kept} messages"
+            + (f", kept {kept} that couldn't be unpublished" if kept else "")
+        )
+
+    async def run(self, interval=3600, unpublish=None):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                evictions = await loop.run_in_executor(self.executor, self.compact)
+                if evictions:
+                    await self._evict(evictions, unpublish)
+            except Exception:
+                logger.exception("Retention pass failed")
+            await asyncio.sleep(interval)
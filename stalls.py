@@ -0,0 +1,147 @@
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import logging
+import threading
+import traceback
+
+logger = logging.getLogger(__name__)
+
+
+class StallDetector:
+    """
+    Opt-in diagnostic for blocking calls on the event loop.
+
+    A heartbeat coroutine measures loop lag continuously. A watchdog thread
+    notices when the heartbeat is late by more than `threshold` seconds and
+    captures the loop thread's stack at that moment, i.e. the callback that
+    is holding the loop. Stalls are grouped by their innermost `stack_depth`
+    frames; counts and the worst offenders are logged every
+    `report_interval` seconds and written to `dump_path` on SIGUSR1.
+    """
+
+    def __init__(self, threshold=0.1, report_interval=300, dump_path="stalls.json", stack_depth=8):
+        self.threshold = float(threshold)
+        self.report_interval = float(report_interval)
+        self.dump_path = dump_path
+        self.stack_depth = int(stack_depth)
+        self.tick = self.threshold / 2
+
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.last_tick = time.monotonic()
+        self.pending_stack = None
+        self.offenders = {}
+        self.lag = {"samples": 0, "total": 0.0, "max": 0.0}
+        self.tasks = []
+
+    @classmethod
+    def from_config(cls, options):
+        """Detector for a [diagnostics] config section, None unless `stall_threshold` > 0"""
+        threshold = float(options.get("stall_threshold") or 0)
+        if threshold <= 0:
+            return None
+        return cls(
+            threshold,
+            report_interval=options.get("stall_report_interval") or 300,
+            dump_path=options.get("stall_dump_path") or "stalls.json",
+        )
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        self.tasks = [
+            asyncio.create_task(self._heartbeat()),
+            asyncio.create_task(self._reporter()),
+        ]
+        threading.Thread(target=self._watchdog, name="stall-watchdog", daemon=True).start()
+        try:
+            loop.add_signal_handler(signal.SIGUSR1, self.dump)
+        except (NotImplementedError, AttributeError, RuntimeError):
+            pass
+        logger.info(f"Stall detector started, threshold {self.threshold}s, pid {os.getpid()}")
+
+    def stop(self):
+        self.stopped.set()
+        for task in self.tasks:
+            task.cancel()
+
+    async def _heartbeat(self):
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self.tick)
+            now = time.monotonic()
+            lag = now - before - self.tick
+            with self.lock:
+                self.last_tick = now
+                self.lag["samples"] += 1
+                self.lag["total"] += lag
+                self.lag["max"] = max(self.lag["max"], lag)
+                if self.pending_stack is not None:
+                    self._record(self.pending_stack, lag)
+                    self.pending_stack = None
+
+    def _watchdog(self):
+        while not self.stopped.wait(self.tick / 2):
+            with self.lock:
+                late = time.monotonic() - self.last_tick - self.tick
+                if late < self.threshold or self.pending_stack is not None:
+                    continue
+                frame = sys._current_frames().get(self.loop_thread_id)
+                if frame is None:
+                    continue
+                self.pending_stack = traceback.extract_stack(frame)[-self.stack_depth:]
+
+    def _record(self, stack, duration):
+        key = tuple((frame.filename, frame.lineno, frame.name) for frame in stack)
+        offender = self.offenders.get(key)
+        if offender is None:
+            offender = self.offenders[key] = {
+                "count": 0,
+                "total": 0.0,
+                "max": 0.0,
+                "stack": "".join(traceback.format_list(stack)),
+            }
+            logger.warning(
+                "Event loop blocked for %.3fs (new offender):\n%s", duration, offender["stack"]
+            )
+        offender["count"] += 1
+        offender["total"] += duration
+        offender["max"] = max(offender["max"], duration)
+
+    def report(self, top=5):
+        with self.lock:
+            worst = sorted(self.offenders.values(), key=lambda offender: -offender["total"])
+            return {
+                "threshold": self.threshold,
+                "lag_avg": self.lag["total"] / max(self.lag["samples"], 1),
+                "lag_max": self.lag["max"],
+                "stalls": sum(offender["count"] for offender in worst),
+                "offenders": [dict(offender) for offender in worst[:top]],
+            }
+
+    def dump(self):
+        with open(self.dump_path, "w") as f:
+            json.dump(self.report(top=len(self.offenders)), f, indent=2)
+        logger.info(f"Stall report written to {self.dump_path}")
+
+    async def _reporter(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            report = self.report()
+            if not report["stalls"]:
+                continue
+            logger.warning(
+                "Event loop stalls: %d, lag avg %.4fs max %.3fs. Worst offenders:\n%s",
+                report["stalls"],
+                report["lag_avg"],
+                report["lag_max"],
+                "\n".join(
+                    f"  {o['count']}x, total {o['total']:.2f}s, max {o['max']:.3f}s at\n{o['stack']}"
+                    for o in report["offenders"]
+                ),
+            )
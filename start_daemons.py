@@ -10,6 +10,7 @@ from cities import cities
 root_path = "/var/www/TGMessageDownloader"
 script_path = f"{root_path}/load_history.py"
 base_config_path = "./conf.d/"
+transcoder_socket = f"{root_path}/transcoder.sock"
 service_path = "/etc/systemd/system/"
 # service_path = "./system/" # use for tests/checks
 
@@ -31,14 +32,33 @@ video_path = ${{media_path}}/videos
 thumbnail_path = ${{media_path}}/thumbnails
 fastimage_path = ${{media_path}}/fastimages
 
+[renditions]
+transcoder_socket = {TRANSCODER_SOCKET}
+transcoder_city = {CITY}
+
 [info]
 channel = {CHANNEL_ID}
 start_date = 2024-12-01
 ; start_date = 2024-08-26
 """
 
+transcoder_service_template = f"""[Unit]
+Description=Shared media transcoder for BLM daemons
+
+[Service]
+ExecStart={root_path}/env/bin/python {root_path}/transcoder.py --socket {transcoder_socket}
+WorkingDirectory={root_path}
+Restart=always
+Nice=10
+
+[Install]
+WantedBy=multi-user.target
+"""
+
 service_template = f"""[Unit]
 Description=BLM for {{CITY}}
+After=tg-transcoder.service
+Wants=tg-transcoder.service
 
 [Service]
 ExecStart={root_path}/env/bin/python {root_path}/blm.py --config config.ini
@@ -56,6 +76,11 @@ def create_configs():
     os.makedirs(base_config_path, exist_ok=True)
     os.makedirs(service_path, exist_ok=True)
 
+    transcoder_service_file_path = os.path.join(service_path, "tg-transcoder.service")
+    with open(transcoder_service_file_path, "w") as service_file:
+        service_file.write(transcoder_service_template)
+    print(f"Created service file at {transcoder_service_file_path}")
+
     for data in cities:
         city, port, channel_id, bot_token = (
             data["city"],
@@ -71,7 +96,8 @@ def create_configs():
         # Generate config content
         config_content = config_template.format(
             CITY=city, PORT=port, CHANNEL_ID=channel_id, BOT_TOKEN=bot_token,
-            API_ID=api_id, API_HASH=api_hash, PHONE=phone
+            API_ID=api_id, API_HASH=api_hash, PHONE=phone,
+            TRANSCODER_SOCKET=transcoder_socket,
         )
 
         # Save config file in city's directory
@@ -101,6 +127,9 @@ def run_daemons():
         "--config",
         "config.ini",  # Passing the config file as an argument
     ]
+    subprocess.run(["systemctl", "enable", "tg-transcoder"])
+    subprocess.run(["systemctl", "start", "tg-transcoder"])
+
     # Iterate through each city
     for data in cities:
         city = data["city"]
@@ -5,17 +5,17 @@ import asyncio
 import aiohttp
 import pathlib
 import logging
-import decord
-import PIL
-import emoji
 import codecs
+import threading
 
 logger = logging.getLogger(__name__)
 
 
 def create_output_directories(*args):
     for path in args:
-        os.makedirs(path, exist_ok=True)
+        # An empty path is the current directory, e.g. the dirname of a bare filename
+        if path:
+            os.makedirs(path, exist_ok=True)
 
 
 def write_messages_to_file(messages, filename):
@@ -23,6 +23,35 @@ def write_messages_to_file(messages, filename):
         json.dump(messages, f, ensure_ascii=False)
 
 
+def iter_messages_from_file(filename, chunk_size=1024 * 1024):
+    """Yields items of a JSON array written by `write_messages_to_file` without loading it whole"""
+    decoder = json.JSONDecoder()
+    separators = re.compile(r"[\s,]*")
+    with codecs.open(filename, "r", "utf-8") as f:
+        buffer = f.read(chunk_size).lstrip()
+        if not buffer.startswith("["):
+            raise ValueError(f"{filename} is not a JSON array")
+        # Items are decoded in place by index; the consumed prefix is only
+        # dropped when the next chunk is read, once per chunk
+        index = 1
+        eof = False
+        while True:
+            index = separators.match(buffer, index).end()
+            if buffer.startswith("]", index):
+                return
+            try:
+                item, index = decoder.raw_decode(buffer, index)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[index:] + chunk
+                index = 0
+                continue
+            yield item
+
+
 # Функция для проверки хэштегов с форматированием
 def has_valid_hashtag(text: str, hashtags: list[str]):
     formatted_text = re.sub(
@@ -64,28 +93,62 @@ def convert_group_to_data(group):
     }
 
 
-async def send_to_api(url, data):
+# Seconds an API call may take before it counts as a network error
+API_TIMEOUT = 30
+
+
+class ApiResult:
+    """
+    Outcome of an API call, truthy when the API accepted it. `status` is
+    None when no response arrived at all.
+    """
+
+    def __init__(self, status=None):
+        self.status = status
+
+    def __bool__(self):
+        return self.status is not None and 200 <= self.status < 300
+
+    @property
+    def retryable(self):
+        """Network errors, 5xx, timeouts and rate limits may succeed later; other 4xx won't"""
+        return self.status is None or self.status >= 500 or self.status in (408, 429)
+
+    def __repr__(self):
+        return f"ApiResult({self.status})"
+
+
+def _api_session():
+    return aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=API_TIMEOUT))
+
+
+async def send_to_api(url, data, session=None):
+    if session is None:
+        async with _api_session() as session:
+            return await send_to_api(url, data, session)
+
     origin = "https://topsmi.ru/"
-    logger.debug(f"Sending {data} to {url}")
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.put(
-                url, json=data, headers={"origin": origin}
-            ) as response:
-                if response.ok:
-                    logger.info(f"Message successfully sent to Next.js API: {data}")
-                else:
-                    logger.warn(
-                        f"Failed to send message '{data}': {response.status}, {await response.text()}"
-                    )
-        except Exception as e:
-            logger.warn(f"Error sending message to API: {e}. Data: {data}")
+    logger.debug("Sending %s to %s", data, url)
+    try:
+        async with session.put(
+            url, json=data, headers={"origin": origin}
+        ) as response:
+            if response.ok:
+                logger.info("Message successfully sent to Next.js API: %s", data)
+            else:
+                logger.warn(
+                    f"Failed to send message '{data}': {response.status}, {await response.text()}"
+                )
+            return ApiResult(response.status)
+    except Exception as e:
+        logger.warn(f"Error sending message to API: {e}. Data: {data}")
+        return ApiResult()
 
 
 async def delete_news(url, message_id):
     origin = "https://topsmi.ru/"
     logger.debug(f"Sending delete to {url} with {message_id}")
-    async with aiohttp.ClientSession() as session:
+    async with _api_session() as session:
         try:
             async with session.delete(
                 url, params={"messageId": message_id}, headers={"origin": origin}
@@ -98,19 +161,74 @@ async def delete_news(url, message_id):
                     logger.warn(
                         f"Failed to send message: {response.status}, {await response.text()}"
                     )
+                return ApiResult(response.status)
         except Exception as e:
             logger.warn(f"Error sending message to API: {e}. Data: {message_id}")
+            return ApiResult()
+
+
+def shard_subdir(filename):
+    """
+    Subdirectory of `filename` in the sharded layout: the last two pairs of
+    digits of the message id, so `123456.webp` lives in `56/34/`.
+    """
+    stem = os.path.splitext(os.path.basename(filename))[0].zfill(4)
+    return os.path.join(stem[-2:], stem[-4:-2])
+
+
+def media_file_path(directory, filename, sharded=False):
+    """Path of `filename` inside `directory` in the flat or the sharded layout"""
+    filename = os.path.basename(filename)
+    if sharded:
+        return os.path.join(directory, shard_subdir(filename), filename)
+    return os.path.join(directory, filename)
+
+
+def find_media_file(directory, filename):
+    """Existing path of `filename` in either layout (sharded first), or None"""
+    for sharded in (True, False):
+        path = media_file_path(directory, filename, sharded)
+        if os.path.exists(path):
+            return path
+    return None
 
 
 def is_media_downloaded(message_id, *paths):
+    """Files named `{message_id}.*` in any of `paths`, in either layout"""
     for path in paths:
-        files = list(pathlib.Path(path).glob(f"{message_id}.*"))
-        if files:
-            return files
+        for directory in (os.path.join(path, shard_subdir(str(message_id))), path):
+            files = list(pathlib.Path(directory).glob(f"{message_id}.*"))
+            if files:
+                return files
     return []
 
 
+def temporary_path(path):
+    """
+    Sibling of `path` to write to before `os.replace`-ing it into place, so
+    concurrent writers never leave a torn file. Hidden, so `{id}.*` globs skip it.
+    """
+    directory, filename = os.path.split(path)
+    root, ext = os.path.splitext(filename)
+    return os.path.join(directory, f".{root}.{os.getpid()}-{threading.get_ident()}.tmp{ext}")
+
+
+def save_image_atomically(img, path, **options):
+    temp_path = temporary_path(path)
+    try:
+        img.save(temp_path, **options)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
 def extract_frame(video_path, output_image_path, frame_number=0):
+    import decord
+    from PIL import Image
+
+    create_output_directories(os.path.dirname(output_image_path))
+
     # Load the video with decord
     video_reader = decord.VideoReader(video_path, ctx=decord.cpu(0))
 
@@ -118,8 +236,8 @@ def extract_frame(video_path, output_image_path, frame_number=0):
     frame = video_reader[frame_number]
 
     # Convert frame to a PIL Image and save as JPEG
-    image = PIL.Image.fromarray(frame.asnumpy())
-    image.save(output_image_path)
+    image = Image.fromarray(frame.asnumpy())
+    save_image_atomically(image, output_image_path)
 
 
 # Function to preserve hashtags within markdown
@@ -143,6 +261,8 @@ def remove_bold(text):
 
 # Function to remove emojis
 def remove_emojis(text):
+    import emoji
+
     return emoji.replace_emoji(text)
 
 
@@ -205,40 +325,84 @@ def generate_new_file_path(dest_dir, filename, new_extension="webp"):
     return os.path.join(dest_dir, f"{filename_without_ext}.{new_extension}")
 
 
-def compress_thumbnail(image_path, new_file_path, quality=50, width=300):
-    """Compress an image as a thumbnail and save it with the given new file path."""
-    img = PIL.Image.open(image_path)
-    height = int((width / img.size[0]) * img.size[1])
-    img = img.resize((width, height), resample=PIL.Image.LANCZOS)
+# Conservative lossy WebP encode throughput per `method` in megapixels per
+# second on real photos, used to pick the slowest (= smallest output) method
+# that fits the time budget. Calibrate with `benchmarks/webp_profiles.py`
+# on the target host; overestimating it blows the budget.
+WEBP_MPIXELS_PER_SECOND = {6: 3.4, 5: 4.5, 4: 6.0, 3: 6.5, 2: 16.0, 1: 20.0, 0: 20.0}
+# Methods above 4 cost a lot more time for a couple of percent in size,
+# so they are never picked (4 is also Pillow's default)
+WEBP_MAX_METHOD = 4
+# Lossless encoding is about an order of magnitude slower than lossy
+WEBP_LOSSLESS_SLOWDOWN = 10
+# Default CPU time budget for encoding one image, in seconds
+WEBP_TIME_BUDGET = 0.25
+# Sources this small are usually graphics/screenshots that compress better lossless
+LOSSLESS_MAX_SOURCE_PIXELS = 400 * 400
 
-    # Change the extension to .webp in the new file path
-    new_file_path = os.path.splitext(new_file_path)[0] + ".webp"
 
-    try:
-        img.save(new_file_path, quality=quality, optimize=True)
-    except OSError:
-        img = img.convert("RGB")
-        img.save(new_file_path, quality=quality, optimize=True)
-    finally:
-        img.close()
+def choose_webp_profile(width, height, quality, time_budget=WEBP_TIME_BUDGET, allow_lossless=False, source_pixels=None):
+    """Returns WebP save options for an output of `width`x`height` that fit the time budget."""
+    mpixels = width * height / 1_000_000
 
-    return new_file_path
+    def fits(method, slowdown=1):
+        return mpixels * slowdown / WEBP_MPIXELS_PER_SECOND[method] <= time_budget
 
+    if allow_lossless and (source_pixels or width * height) <= LOSSLESS_MAX_SOURCE_PIXELS:
+        for method in range(WEBP_MAX_METHOD, -1, -1):
+            if fits(method, WEBP_LOSSLESS_SLOWDOWN):
+                # for lossless `quality` is the compression effort
+                return {"lossless": True, "method": method, "quality": 100}
 
-def compress_image(image_path, new_file_path, ratio=0.5, quality=50):
-    """Compress an image by scaling it and save it with the given new file path."""
-    img = PIL.Image.open(image_path)
-    img = img.resize((int(img.size[0] * ratio), int(img.size[1] * ratio)), resample=PIL.Image.LANCZOS)
+    method = next((method for method in range(WEBP_MAX_METHOD, -1, -1) if fits(method)), 0)
+    return {"lossless": False, "method": method, "quality": quality}
+
+
+def prepare_for_webp(img):
+    """Converts to a mode WebP can encode directly, so the image is encoded only once."""
+    if img.mode in ("RGB", "RGBA"):
+        return img
+    if img.mode in ("LA", "PA") or "transparency" in img.info:
+        return img.convert("RGBA")
+    return img.convert("RGB")
 
-    # Change the extension to .webp in the new file path
+
+def save_webp(img, new_file_path, quality, time_budget=WEBP_TIME_BUDGET, allow_lossless=False, source_pixels=None):
+    """Save `img` as WebP using a profile picked for its size. Returns the path written."""
     new_file_path = os.path.splitext(new_file_path)[0] + ".webp"
+    create_output_directories(os.path.dirname(new_file_path))
+    img = prepare_for_webp(img)
+    profile = choose_webp_profile(
+        *img.size, quality, time_budget, allow_lossless, source_pixels
+    )
+    save_image_atomically(img, new_file_path, format="WEBP", **profile)
+    return new_file_path
 
-    try:
-        img.save(new_file_path, quality=quality, optimize=True)
-    except OSError:
-        img = img.convert("RGB")
-        img.save(new_file_path, quality=quality, optimize=True)
-    finally:
-        img.close()
 
-    return new_file_path
\ No newline at end of file
+def compress_thumbnail(image_path, new_file_path, quality=50, width=300, time_budget=WEBP_TIME_BUDGET, source_pixels=None):
+    """
+    Compress an image as a thumbnail and save it with the given new file path.
+    `source_pixels` is the original's pixel count when `image_path` is a
+    smaller copy of it (it decides whether lossless is worth it).
+    """
+    from PIL import Image
+
+    with Image.open(image_path) as img:
+        source_pixels = source_pixels or img.size[0] * img.size[1]
+        height = int((width / img.size[0]) * img.size[1])
+        img = prepare_for_webp(img).resize((width, height), resample=Image.LANCZOS)
+        return save_webp(
+            img, new_file_path, quality, time_budget,
+            allow_lossless=True, source_pixels=source_pixels,
+        )
+
+
+def compress_image(image_path, new_file_path, ratio=0.5, quality=50, time_budget=WEBP_TIME_BUDGET):
+    """Compress an image by scaling it and save it with the given new file path."""
+    from PIL import Image
+
+    with Image.open(image_path) as img:
+        img = prepare_for_webp(img)
+        if ratio != 1:
+            img = img.resize((int(img.size[0] * ratio), int(img.size[1] * ratio)), resample=Image.LANCZOS)
+        return save_webp(img, new_file_path, quality, time_budget)
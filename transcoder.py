@@ -0,0 +1,252 @@
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import json
+import logging
+import os
+
+import tgutils
+import logutils
+
+logger = logging.getLogger(__name__)
+
+# Jobs the service is allowed to run, by name
+JOBS = {
+    "compress_image": tgutils.compress_image,
+    "compress_thumbnail": tgutils.compress_thumbnail,
+    "extract_frame": tgutils.extract_frame,
+}
+# Live posts are always taken before backfill
+PRIORITIES = ("live", "backfill")
+
+
+class FairQueue:
+    """
+    Jobs grouped by priority, then by city. Within a priority cities are
+    served round-robin, so one city's burst can't starve the others.
+    """
+
+    def __init__(self):
+        self.queues = {priority: collections.OrderedDict() for priority in PRIORITIES}
+        self.available = asyncio.Semaphore(0)
+
+    def put(self, job, city, priority):
+        if priority not in self.queues:
+            priority = PRIORITIES[-1]
+        self.queues[priority].setdefault(city, collections.deque()).append(job)
+        self.available.release()
+
+    async def get(self):
+        await self.available.acquire()
+        for priority in PRIORITIES:
+            cities = self.queues[priority]
+            if not cities:
+                continue
+            city, jobs = next(iter(cities.items()))
+            job = jobs.popleft()
+            if jobs:
+                cities.move_to_end(city)
+            else:
+                del cities[city]
+            return job
+
+    def __len__(self):
+        return sum(
+            len(jobs) for cities in self.queues.values() for jobs in cities.values()
+        )
+
+
+class TranscoderServer:
+    """
+    Local rendition service for all city daemons. Accepts newline-delimited
+    JSON requests on a Unix socket and runs them on a fixed number of
+    worker processes.
+    """
+
+    def __init__(self, socket_path, workers=2):
+        self.socket_path = socket_path
+        self.workers = int(workers)
+        self.queue = FairQueue()
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job_name, args, kwargs, started, future = await self.queue.get()
+            # The client went away while the job was queued
+            if future.cancelled():
+                continue
+            started.set_result(None)
+            try:
+                result = await loop.run_in_executor(
+                    self.pool, functools.partial(JOBS[job_name], *args, **kwargs)
+                )
+                if not future.done():
+                    future.set_result(result)
+            except concurrent.futures.process.BrokenProcessPool as e:
+                logger.error("Worker pool broke, restarting it")
+                self.pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+                if not future.done():
+                    future.set_exception(e)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+
+    @staticmethod
+    async def _send(writer, message):
+        writer.write(json.dumps(message).encode() + b"\n")
+        await writer.drain()
+
+    async def _handle_client(self, reader, writer):
+        """
+        Serves requests of one connection in order. A client disconnecting
+        while its job is queued cancels the job.
+        """
+        try:
+            line = await reader.readline()
+            while line:
+                job = asyncio.create_task(self._handle_request(line, writer))
+                next_line = asyncio.create_task(reader.readline())
+                await asyncio.wait((job, next_line), return_when=asyncio.FIRST_COMPLETED)
+                if next_line.done() and not next_line.result() and not job.done():
+                    job.cancel()
+                    break
+                await self._send(writer, await job)
+                line = await next_line
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, line, writer):
+        """
+        Queues the job of one request line and returns its response. A
+        `{"started": true}` line is sent once a worker picks the job up.
+        """
+        loop = asyncio.get_running_loop()
+        started, future = loop.create_future(), loop.create_future()
+        try:
+            request = json.loads(line)
+            job_name = request["job"]
+            if job_name not in JOBS:
+                raise ValueError(f"Unknown job '{job_name}'")
+            self.queue.put(
+                (job_name, request.get("args", []), request.get("kwargs", {}), started, future),
+                request.get("city", ""),
+                request.get("priority", PRIORITIES[-1]),
+            )
+            await started
+            await self._send(writer, {"started": True})
+            return {"ok": True, "result": await future}
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            logger.warning(f"Job failed: {e}")
+            return {"ok": False, "error": f"{type(e).__name__}: {e}"}
+
+    async def serve(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = await asyncio.start_unix_server(self._handle_client, path=self.socket_path)
+        os.chmod(self.socket_path, 0o660)
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"Transcoder listening on {self.socket_path} with {self.workers} workers")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            self.pool.shutdown(cancel_futures=True)
+
+
+class TranscoderError(Exception):
+    pass
+
+
+class TranscoderUnavailable(OSError):
+    """The service closed the connection, sent garbage or didn't answer in time"""
+
+
+class TranscoderClient:
+    """
+    Sends rendition jobs to a running TranscoderServer. Once the service
+    has started a job, waiting for its result is limited to `timeout`
+    seconds (0 waits forever); time spent queued doesn't count.
+    """
+
+    def __init__(self, socket_path, city="", timeout=300):
+        self.socket_path = socket_path
+        self.city = city
+        self.timeout = float(timeout or 0) or None
+
+    @staticmethod
+    async def _read_response(reader, job_name, timeout=None):
+        try:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+        except asyncio.TimeoutError:
+            raise TranscoderUnavailable(f"No response in {timeout}s to '{job_name}'")
+        if not line:
+            # Service restarted or crashed in the middle of the job
+            raise TranscoderUnavailable(f"Connection closed during '{job_name}'")
+        try:
+            return json.loads(line)
+        except ValueError as e:
+            raise TranscoderUnavailable(f"Invalid response to '{job_name}': {e}")
+
+    async def run(self, job_name, *args, priority="live", **kwargs):
+        reader, writer = await asyncio.open_unix_connection(self.socket_path)
+        try:
+            request = {
+                "job": job_name,
+                "args": args,
+                "kwargs": kwargs,
+                "city": self.city,
+                "priority": priority,
+            }
+            writer.write(json.dumps(request).encode() + b"\n")
+            await writer.drain()
+            response = await self._read_response(reader, job_name)
+            if response.get("started"):
+                response = await self._read_response(reader, job_name, self.timeout)
+        finally:
+            # Closing the connection cancels the job if it is still queued
+            writer.close()
+            await writer.wait_closed()
+        if not response["ok"]:
+            raise TranscoderError(response["error"])
+        return response["result"]
+
+
+def load_arguments():
+    parser = argparse.ArgumentParser(description="Shared rendition service for city daemons.")
+    parser.add_argument("-s", "--socket", default="transcoder.sock", help="Unix socket path")
+    parser.add_argument(
+        "-w", "--workers", type=int, default=os.cpu_count() // 2 or 1, help="Worker processes"
+    )
+    return parser.parse_args()
+
+
+def configure_logger(log_folder="logs"):
+    tgutils.create_output_directories(log_folder)
+    logutils.start_queue_logging(
+        handlers=[
+            logging.FileHandler(f"{log_folder}/telegram_transcoder.log"),
+            logging.StreamHandler(),
+        ],
+        level=logging.INFO,
+        fmt="%(asctime)s - %(name)-25s - %(levelname)s - %(message)s",
+    )
+
+
+async def main():
+    configure_logger()
+    args = load_arguments()
+    await TranscoderServer(args.socket, args.workers).serve()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())